@@ -5,6 +5,7 @@ from blocks.bricks.base import Brick
 from blocks.utils import shared_like
 from theano.ifelse import ifelse
 from theano import tensor
+import theano
 import numpy
 
 class Sum(AggregationScheme):
@@ -70,17 +71,49 @@ class ConfusionImage(Brick):
     @application(outputs=["confusion_image"])
     def apply(self, y, y_hat, x):
         predicted = y_hat.argmax(axis=1)
-        # both expanded_y and expanded_y_hat are shape (cases, labels)
-        expanded_y = tensor.extra_ops.to_one_hot(y, y_hat.shape[1])
-        expanded_y_hat = tensor.extra_ops.to_one_hot(predicted, y_hat.shape[1])
-        # pad vectors and elementwise multiply for (cases, labels, labels)
-        expanded_confusion = (tensor.shape_padaxis(expanded_y, 2) *
-                tensor.shape_padaxis(expanded_y_hat, 1))
+        num_labels = y_hat.shape[1]
+        # one-hot of the combined (label, predicted) cell, (cases, labels**2)
+        cells = y * num_labels + predicted
+        membership = tensor.extra_ops.to_one_hot(
+                cells, num_labels ** 2, dtype=x.dtype)
+        # a single matmul scatters each image into its cell
+        flat = x.reshape((x.shape[0], -1))
+        sums = tensor.dot(membership.T, flat)
         # now result is (labels, labels, y_dim, x_dim)
-        result = tensor.tensordot(expanded_confusion, x, axes=([0], [0]))
+        result = sums.reshape((num_labels, num_labels) +
+                tuple(x.shape[i] for i in range(1, x.ndim)), ndim=x.ndim + 1)
         return result
 
-def ablate_inputs(ablation, activations, weights, axis=None, compensate=True):
+class AblationSolver:
+    """Least-squares compensation for many ablations of one activation sample.
+
+    Factors the Gram matrix of the activation sample once, so each query
+    costs a solve in the size of the ablation set instead of a fresh
+    lstsq over all samples.  Since G = A^T A and its inverse H satisfy
+    G_RR H_RK + G_RK H_KK = 0, the least squares fit of the removed
+    columns K by the remaining columns R is X = -H_RK H_KK^-1.
+
+    A small ridge, relative to the mean squared activation, keeps G
+    invertible when some units never fire; the solutions then differ
+    from lstsq's minimum-norm solution only along those dead units.
+    """
+    def __init__(self, activations, ridge=1e-6):
+        activations = numpy.asarray(activations, dtype=numpy.float64)
+        gram = numpy.dot(activations.T, activations)
+        scale = numpy.trace(gram) / len(gram) or 1.0
+        gram[numpy.diag_indices_from(gram)] += ridge * scale
+        self.inverse = numpy.linalg.inv(gram)
+
+    def solve(self, ablation):
+        """Returns the (remaining, removed) least-squares weights X."""
+        remaining = numpy.ones(len(self.inverse), numpy.bool)
+        remaining[ablation] = 0
+        inverse_kk = self.inverse[numpy.ix_(ablation, ablation)]
+        inverse_kr = self.inverse[numpy.ix_(ablation, remaining)]
+        return -numpy.linalg.solve(inverse_kk, inverse_kr).T
+
+def ablate_inputs(ablation, activations, weights, axis=None, compensate=True,
+        solver=None):
     """
     Zeros incoming weights for the given set of input neurons, and
     then approximates the response of those neurons by adjusting
@@ -96,20 +129,25 @@ def ablate_inputs(ablation, activations, weights, axis=None, compensate=True):
         specified by axis, defaulted to 1 (the second axis).
     axis - the axis over which input neurons are listed in the
         weight matrix.
+    solver - an optional AblationSolver built from the same activations,
+        used in place of lstsq to compute the compensation.
     """
     if len(weights.shape) <= 2:
         axis = 0  # Assume a linear weight, where output is on axis 0
     else:
         axis = 1  # Assume a convolutional weight, where output is on axis 1
-    # B contains the activations of the removed neurons
-    B = activations[:, ablation]
-    # A contains the activations of the non-removed neurons
     remaining = numpy.ones(activations.shape[1], numpy.bool)
     remaining[ablation] = 0
-    A = activations[:, remaining]
     # Solve x = np.linagl.lstsq(A, B) for the original layer
     # X dimensions: (remaining, removed)
-    (X, res, rank, s) = numpy.linalg.lstsq(A, B)
+    if solver is not None:
+        X = solver.solve(ablation).astype(weights.dtype)
+    else:
+        # B contains the activations of the removed neurons
+        B = activations[:, ablation]
+        # A contains the activations of the non-removed neurons
+        A = activations[:, remaining]
+        (X, res, rank, s) = numpy.linalg.lstsq(A, B)
     # Extract the set of weights that have been removed
     # import pdb; pdb.set_trace()
     removed_weights = numpy.take(weights, ablation, axis=axis)
@@ -127,3 +165,92 @@ def ablate_inputs(ablation, activations, weights, axis=None, compensate=True):
         result[tuple(remaining
             if a == axis else slice(None) for a in dims)] += adj_weights
     return result
+
+def create_downstream_function(output, layer_output, param=None):
+    """Compiles the part of a network that lies downstream of a layer.
+
+    The returned function takes a batch of precomputed layer_output
+    activations in place of the network input.  If param is given, the
+    function also takes a (K,) + param.shape stack of replacement values
+    for that parameter, evaluates the downstream network once for each
+    of the K variants, and returns outputs stacked on a new first axis.
+
+    output - the network output to compute, e.g., the class probabilities.
+    layer_output - the variable whose values will be supplied directly.
+    param - an optional shared variable downstream of layer_output to vary.
+    """
+    activations = layer_output.type('activations')
+    if param is None:
+        downstream = theano.clone(output, replace={layer_output: activations})
+        return theano.function([activations], downstream)
+    variants = tensor.TensorType(param.dtype,
+            (False,) + param.broadcastable)('variants')
+    def apply_variant(variant, activations):
+        return theano.clone(output,
+                replace={layer_output: activations, param: variant})
+    downstream, _ = theano.map(apply_variant,
+            sequences=[variants], non_sequences=[activations])
+    return theano.function([activations, variants], downstream)
+
+def create_mixing_downstream_function(output, layer_output):
+    """Compiles the downstream network with its input mixed across units.
+
+    The returned function takes a batch of precomputed layer_output
+    activations and a (K, units, units) stack of mixing matrices, and
+    returns outputs stacked on a new first axis.  Variant k replaces
+    each unit c of the layer by sum_j a_j M[k, j, c], where units are
+    channels for convolutional activations.  Unlike weight variants, this
+    works whatever brick lies downstream, e.g., a residual block.
+    """
+    activations = layer_output.type('activations')
+    mixings = tensor.tensor3('mixings', dtype=layer_output.dtype)
+    def apply_variant(mixing, activations):
+        mixed = tensor.tensordot(activations, mixing, axes=([1], [0]))
+        if activations.ndim > 2:
+            # tensordot leaves the unit axis last; move it back to axis 1
+            mixed = mixed.dimshuffle(
+                    (0, activations.ndim - 1) +
+                    tuple(range(1, activations.ndim - 1)))
+        return theano.clone(output, replace={layer_output: mixed})
+    downstream, _ = theano.map(apply_variant,
+            sequences=[mixings], non_sequences=[activations])
+    return theano.function([activations, mixings], downstream)
+
+def ablation_mixing(ablation, num_units, solver=None, dtype='float32'):
+    """Mixing matrix that zeros the ablated units, for use with
+    create_mixing_downstream_function.  If a solver is given, the
+    ablated units are replaced by their least-squares reconstruction
+    from the remaining units, the same compensation ablate_inputs
+    applies to the next layer's weights."""
+    mixing = numpy.eye(num_units, dtype=dtype)
+    mixing[:, ablation] = 0
+    if solver is not None:
+        remaining = numpy.ones(num_units, numpy.bool)
+        remaining[ablation] = 0
+        mixing[numpy.ix_(remaining, ablation)] = solver.solve(ablation)
+    return mixing
+
+def stacked_confusion(y, predicted, num_labels):
+    """Confusion matrices for a (K, cases) array of predicted labels.
+
+    Returns a (K, labels, labels) count array indexed by
+    (variant, correct_label, predicted_label).
+    """
+    num_variants = predicted.shape[0]
+    cells = (numpy.arange(num_variants)[:, None] * num_labels ** 2 +
+             y[None, :] * num_labels + predicted)
+    counts = numpy.bincount(cells.ravel(),
+            minlength=num_variants * num_labels ** 2)
+    return counts.reshape((num_variants, num_labels, num_labels))
+
+def confusion_image_sums(y, predicted, x, num_labels):
+    """NumPy counterpart of ConfusionImage for precomputed predictions.
+
+    Returns a (labels, labels) + image shape array with the sum of the
+    images x in each (correct_label, predicted_label) cell.
+    """
+    cells = y * num_labels + predicted
+    membership = numpy.zeros((num_labels ** 2, len(cells)), dtype=x.dtype)
+    membership[cells, numpy.arange(len(cells))] = 1
+    sums = numpy.dot(membership, x.reshape((len(cells), -1)))
+    return sums.reshape((num_labels, num_labels) + x.shape[1:])
@@ -0,0 +1,193 @@
+"""Cached layer activations for re-evaluating only the top of a network.
+
+Ablation experiments change the weights just above one layer, so the
+activations of that layer over a dataset never change.  They are computed
+once, saved as .npy files next to the model, and reopened with mmap.
+"""
+from collections import OrderedDict
+
+from blocks.graph import ComputationGraph
+from blocks.utils import dict_subset
+import logging
+import theano
+import numpy
+import os.path
+
+def stream_num_examples(data_stream):
+    """Size of the dataset under a stream and any transformers on it."""
+    while not hasattr(data_stream, 'dataset'):
+        data_stream = data_stream.data_stream
+    return data_stream.dataset.num_examples
+
+class ActivationSampler:
+    """Collects a sample of several layer outputs in one pass over a stream.
+
+    The Theano function is compiled once, on construction, and batches are
+    written into preallocated (n, ...) buffers.  With reservoir=True the
+    sample is drawn uniformly from the whole stream (Algorithm R) rather
+    than taken from its first n examples.
+
+    outputs - an OrderedDict from names to the variables to collect.
+    sources - names of stream sources, e.g., 'targets', collected alongside.
+    """
+    def __init__(self, outputs, sources=()):
+        self.names = list(outputs.keys())
+        self.sources = tuple(sources)
+        cg = ComputationGraph(list(outputs.values()))
+        self.input_names = [v.name for v in cg.inputs]
+        self.fn = theano.function(cg.inputs, list(outputs.values()))
+
+    def batches(self, data_stream):
+        for batch in data_stream.get_epoch_iterator(as_dict=True):
+            values = self.fn(**dict_subset(batch, self.input_names))
+            yield OrderedDict(list(zip(self.names, values)) +
+                    [(source, batch[source]) for source in self.sources])
+
+    def sample(self, data_stream, n=None, reservoir=False, seed=1,
+            prefix=None):
+        """Returns an OrderedDict of (n, ...) arrays for each name and source.
+
+        n defaults to the size of the stream's dataset.  If the stream is
+        shorter than n, the arrays are truncated to the examples seen.
+        With a prefix, the buffers are .npy files opened with open_memmap
+        rather than arrays in memory, and they are returned mmapped.
+        """
+        if n is None:
+            n = stream_num_examples(data_stream)
+        rng = numpy.random.RandomState(seed)
+        buffers = None
+        seen = 0
+        for values in self.batches(data_stream):
+            if buffers is None:
+                buffers = OrderedDict((name, _allocate(
+                    prefix, name, (n,) + v.shape[1:], v.dtype))
+                    for name, v in values.items())
+            size = len(next(iter(values.values())))
+            # Fill the buffer in order until it is full
+            fill = max(0, min(size, n - seen))
+            for name, v in values.items():
+                buffers[name][seen:seen + fill] = v[:fill]
+            if fill < size and reservoir:
+                # Example t replaces a random slot with probability n / t
+                slots = rng.randint(0, numpy.arange(
+                    seen + fill, seen + size) + 1)
+                keep = slots < n
+                for name, v in values.items():
+                    buffers[name][slots[keep]] = v[fill:][keep]
+            seen += size
+            if seen >= n and not reservoir:
+                break
+        if buffers is None:
+            return None
+        if seen < n:
+            logging.warning("Stream had only {} of {} examples".format(
+                seen, n))
+        if prefix is None:
+            return OrderedDict((name, b[:min(seen, n)])
+                    for name, b in buffers.items())
+        for name, b in buffers.items():
+            _finish(prefix, name, b, min(seen, n))
+        return OrderedDict((name, numpy.load(
+            _cache_filename(prefix, name), mmap_mode='r'))
+            for name in buffers)
+
+def _allocate(prefix, name, shape, dtype):
+    if prefix is None:
+        return numpy.empty(shape, dtype=dtype)
+    return numpy.lib.format.open_memmap(
+            _cache_filename(prefix, name) + '.tmp', mode='w+',
+            dtype=dtype, shape=shape)
+
+def _finish(prefix, name, buffer, count):
+    """Moves a filled memmap into place, truncated to count rows."""
+    filename = _cache_filename(prefix, name)
+    buffer.flush()
+    if count < len(buffer):
+        numpy.save(filename, buffer[:count])
+        os.remove(filename + '.tmp')
+    else:
+        os.replace(filename + '.tmp', filename)
+
+def extract_sample(activations, data_stream, n=2000, reservoir=False,
+        seed=1):
+    """Samples n rows of one layer's activations from data_stream."""
+    sampler = ActivationSampler(OrderedDict([('activations', activations)]))
+    return sampler.sample(data_stream, n, reservoir, seed)['activations']
+
+def extract_activations(activations, data_stream, sources=('targets',),
+        prefix=None):
+    """Runs a whole epoch of data_stream, collecting activations in order.
+
+    Returns an OrderedDict with the 'activations' and the matching values
+    of each of the given stream sources.  With a prefix they are written
+    straight to the .npy files of an activation cache.
+    """
+    sampler = ActivationSampler(
+            OrderedDict([('activations', activations)]), sources)
+    return sampler.sample(data_stream, prefix=prefix)
+
+def sample_rows(values, n=2000, seed=1):
+    """Draws n rows uniformly without replacement, in their stored order,
+    so that reading them from an mmapped cache stays sequential."""
+    if len(values) <= n:
+        return numpy.asarray(values)
+    rng = numpy.random.RandomState(seed)
+    return numpy.asarray(values[numpy.sort(
+        rng.choice(len(values), n, replace=False))])
+
+def cache_prefix(save_to, layer_name, split='test'):
+    """Names the cache for a layer of the model saved in save_to."""
+    return '{}.{}.{}'.format(save_to, layer_name.strip('/').replace('/', '-'),
+            split)
+
+def _cache_filename(prefix, name):
+    return '{}.{}.npy'.format(prefix, name)
+
+def load_activation_cache(prefix, sources=('targets',), mmap_mode='r',
+        newer_than=None):
+    """Opens a saved cache, or returns None if it is missing or stale."""
+    names = ('activations',) + tuple(sources)
+    filenames = [_cache_filename(prefix, name) for name in names]
+    if not all(os.path.exists(f) for f in filenames):
+        return None
+    if newer_than is not None and any(os.path.getmtime(f) <
+            os.path.getmtime(newer_than) for f in filenames):
+        return None
+    return OrderedDict((name, numpy.load(f, mmap_mode=mmap_mode))
+            for name, f in zip(names, filenames))
+
+def cache_activations(prefix, activations, data_stream,
+        sources=('targets',), mmap_mode='r', newer_than=None):
+    """Loads cached activations, computing and saving them if needed.
+
+    prefix - file prefix for the cache, e.g., from cache_prefix.
+    activations - the layer output variable to cache.
+    data_stream - the stream to run, which should not be shuffled.
+    sources - stream sources to cache alongside, e.g., the labels.
+    newer_than - a file (usually the saved model) the cache must postdate.
+    """
+    cache = load_activation_cache(prefix, sources, mmap_mode, newer_than)
+    if cache is None:
+        extract_activations(activations, data_stream, sources, prefix)
+        cache = load_activation_cache(prefix, sources, mmap_mode)
+    return cache
+
+def predict_downstream(downstream, activations, variants=None,
+        batch_size=500):
+    """Runs a downstream function over cached activations in batches.
+
+    downstream - a function from create_downstream_function.
+    variants - the stacked parameter values, if the function takes them.
+
+    Returns the predicted label for each case, or a (K, cases) array of
+    predictions when K variants are given.
+    """
+    predictions = []
+    for start in range(0, activations.shape[0], batch_size):
+        batch = numpy.asarray(activations[start:start + batch_size])
+        if variants is None:
+            probs = downstream(batch)
+        else:
+            probs = downstream(batch, variants)
+        predictions.append(probs.argmax(axis=-1))
+    return numpy.concatenate(predictions, axis=-1)
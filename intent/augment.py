@@ -0,0 +1,154 @@
+"""Augmentation of the CIFAR training batches inside the Theano graph.
+
+RandomPadCropFlip pads, crops and flips every batch on the host, and the
+augmented batch is then copied to the device.  Here the training set is
+copied to the device once, as shared variables, so each step transfers
+only the indices of its examples:
+
+```
+device = DeviceDataset(cifar10_train)
+indices = tensor.lvector('indices')
+x, y = device.batch(indices, levels=levels)
+x = PadCropFlip((32, 32), pad=4).apply(x)
+stream = device.index_stream(ShuffledScheme(device.num_examples, 128))
+```
+
+The crop offsets and flips are drawn from MRG_RandomStreams, so they are
+sampled on the device too.  The arrays are stored as floatX, targets
+included, since the old CUDA backend only moves float32 shared variables
+to the GPU; CIFAR10 then takes 600MB of device memory.  Checkpoints
+pickle the training function, so pass the DeviceDataset to the
+EpochCheckpoint, which leaves its arrays out of the file.
+"""
+from collections import OrderedDict
+import contextlib
+
+import theano
+from theano import tensor
+
+from blocks.bricks import Random
+from blocks.bricks import application
+from fuel.datasets import IndexableDataset
+from fuel.streams import DataStream
+import numpy
+
+def normalize_levels(features, levels=None):
+    """Normalizes each channel of a symbolic batch as NormalizeBatchLevels
+    does, or by the (mean, std) levels when given, as NormalizeLevels."""
+    if levels is not None:
+        mean, std = (tensor.constant(numpy.asarray(level,
+            dtype=features.dtype)[None, :, None, None]) for level in levels)
+        return (features - mean) / std
+    zeroed = features - features.mean(axis=(0, 2, 3), keepdims=True)
+    return zeroed / tensor.sqrt(
+            tensor.sqr(zeroed).mean(axis=(0, 2, 3), keepdims=True))
+
+class DeviceDataset(object):
+    """The sources of a dataset held on the device as shared variables.
+
+    Parameters
+    ----------
+    dataset : Dataset
+        A dataset that answers a slice request for all of its examples,
+        e.g., CIFAR10 or a MemmapDataset.
+    sources : tuple of str
+        The features and targets sources.
+    """
+    def __init__(self, dataset, sources=('features', 'targets')):
+        state = dataset.open()
+        data = dict(zip(dataset.sources, dataset.get_data(
+            state, slice(0, dataset.num_examples))))
+        dataset.close(state)
+        self.num_examples = dataset.num_examples
+        features, targets = (numpy.asarray(data[source])
+                for source in sources)
+        # As the default transformers of Fuel's image datasets
+        scale = 1 / 255.0 if features.dtype.kind in 'iu' else 1
+        self.features = theano.shared(numpy.asarray(
+            features * scale, dtype=theano.config.floatX),
+            name='device_' + sources[0])
+        self.targets = theano.shared(numpy.asarray(
+            targets, dtype=theano.config.floatX),
+            name='device_' + sources[1])
+
+    def batch(self, indices, levels=None):
+        """The symbolic (features, targets) of the examples at indices,
+        features normalized by normalize_levels."""
+        features = self.features[indices]
+        targets = tensor.cast(self.targets[indices], 'int64')
+        return normalize_levels(features, levels), targets
+
+    @contextlib.contextmanager
+    def detached(self):
+        """Empties the shared variables for the duration, e.g., while a
+        checkpoint pickles the training function that refers to them."""
+        shared = [self.features, self.targets]
+        values = [v.get_value(borrow=True, return_internal_type=True)
+                for v in shared]
+        try:
+            for v in shared:
+                v.set_value(numpy.zeros((0,) * v.ndim, dtype=v.dtype))
+            yield
+        finally:
+            for v, value in zip(shared, values):
+                v.set_value(value, borrow=True)
+
+    def index_stream(self, iteration_scheme):
+        """A stream of the batches of indices of iteration_scheme."""
+        return DataStream(IndexableDataset(OrderedDict(
+            [('indices', numpy.arange(self.num_examples))])),
+            iteration_scheme=iteration_scheme)
+
+class PadCropFlip(Random):
+    """Zero-pads a batch of images, crops a random window from each
+    and flips it horizontally with probability one half.
+
+    Matches RandomPadCropFlip, but as a graph stage on a symbolic
+    (batch, channel, height, width) batch.
+
+    Parameters
+    ----------
+    window_shape : tuple of int
+        The (height, width) of the crops.
+    pad : int
+        Zeros added on each side before cropping.
+    x_flip : bool
+        Whether to flip at random.
+    """
+    def __init__(self, window_shape, pad=0, x_flip=True, **kwargs):
+        self.window_shape = window_shape
+        self.pad = pad
+        self.x_flip = x_flip
+        super(PadCropFlip, self).__init__(**kwargs)
+
+    def random_offsets(self, batch_size, max_offset):
+        offsets = tensor.floor(self.theano_rng.uniform((batch_size,),
+            dtype=theano.config.floatX) * (max_offset + 1))
+        return tensor.minimum(tensor.cast(offsets, 'int64'), max_offset)
+
+    @application(inputs=['input_'], outputs=['output'])
+    def apply(self, input_):
+        batch_size, channels, height, width = input_.shape
+        pad = self.pad
+        if pad:
+            padded = tensor.zeros((batch_size, channels,
+                height + 2 * pad, width + 2 * pad), dtype=input_.dtype)
+            input_ = tensor.set_subtensor(
+                    padded[:, :, pad:pad + height, pad:pad + width], input_)
+            height, width = height + 2 * pad, width + 2 * pad
+        window_height, window_width = self.window_shape
+        rows = (self.random_offsets(batch_size, height - window_height
+            ).dimshuffle(0, 'x') + tensor.arange(window_height))
+        cols = (self.random_offsets(batch_size, width - window_width
+            ).dimshuffle(0, 'x') + tensor.arange(window_width))
+        if self.x_flip:
+            flips = self.theano_rng.uniform((batch_size,),
+                    dtype=theano.config.floatX) < 0.5
+            cols = tensor.switch(flips.dimshuffle(0, 'x'), cols[:, ::-1], cols)
+        # Gather all crops at once, one pixel of all channels per index
+        pixels = ((tensor.arange(batch_size).dimshuffle(0, 'x', 'x') * height
+            + rows.dimshuffle(0, 1, 'x')) * width + cols.dimshuffle(0, 'x', 1))
+        crops = input_.dimshuffle(0, 2, 3, 1).reshape(
+                (-1, channels))[pixels.flatten()]
+        return crops.reshape((batch_size, window_height, window_width,
+            channels)).dimshuffle(0, 3, 1, 2)
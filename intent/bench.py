@@ -0,0 +1,321 @@
+"""Micro-benchmarks for the analysis helpers, run on synthetic data."""
+from argparse import ArgumentParser
+from collections import OrderedDict
+import logging
+import os.path
+import shutil
+import tempfile
+import time
+import numpy
+
+def timed(fn, repeat):
+    """Returns the result of fn() and the mean seconds per call."""
+    result = fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return result, (time.perf_counter() - start) / repeat
+
+def report(name, results):
+    print(name)
+    for key, value in results.items():
+        print('  %-24s %s' % (key, value))
+
+def bench_ablation(samples=2000, units=500, outputs=10, ablated=5,
+        queries=20, seed=1, **kwargs):
+    """Per-query compensation latency, lstsq versus AblationSolver."""
+    from intent.ablation import AblationSolver
+    from intent.ablation import ablate_inputs
+    rng = numpy.random.RandomState(seed)
+    # Correlated, sparse, relu-like activations with a few dead units
+    mixing = rng.normal(size=(units // 4, units))
+    activations = numpy.maximum(
+            rng.normal(size=(samples, units // 4)).dot(mixing)
+            + 0.1 * rng.normal(size=(samples, units)), 0).astype('float32')
+    activations[:, rng.choice(units, units // 50, replace=False)] = 0
+    # Linear weights are (input, output) as in blocks
+    weights = rng.normal(size=(units, outputs)).astype('float32')
+    sets = [rng.choice(units, ablated, replace=False).tolist()
+            for _ in range(queries)]
+    setup_start = time.perf_counter()
+    solver = AblationSolver(activations)
+    setup = time.perf_counter() - setup_start
+    def run(solver):
+        return [ablate_inputs(s, activations, weights, solver=solver)
+                for s in sets]
+    expected, lstsq_time = timed(lambda: run(None), 1)
+    actual, solver_time = timed(lambda: run(solver), 1)
+    error = max(numpy.abs(a - e).max() for a, e in zip(actual, expected))
+    report('ablation', OrderedDict([
+        ('shape', activations.shape),
+        ('ablated units', ablated),
+        ('solver setup (ms)', '%.2f' % (setup * 1e3)),
+        ('lstsq query (ms)', '%.2f' % (lstsq_time / queries * 1e3)),
+        ('solver query (ms)', '%.2f' % (solver_time / queries * 1e3)),
+        ('max weight difference', '%.2g' % error)]))
+
+def outer_product_confusion_image(y, y_hat, x):
+    """The former ConfusionImage, via a (cases, labels, labels) tensor."""
+    from theano import tensor
+    predicted = y_hat.argmax(axis=1)
+    expanded_y = tensor.extra_ops.to_one_hot(y, y_hat.shape[1])
+    expanded_y_hat = tensor.extra_ops.to_one_hot(predicted, y_hat.shape[1])
+    expanded_confusion = (tensor.shape_padaxis(expanded_y, 2) *
+            tensor.shape_padaxis(expanded_y_hat, 1))
+    return tensor.tensordot(expanded_confusion, x, axes=([0], [0]))
+
+def bench_confusion_image(repeat=20, seed=1, **kwargs):
+    """ConfusionImage per-batch time at MNIST and CIFAR batch shapes."""
+    from theano import tensor
+    import theano
+    from intent.ablation import ConfusionImage
+    rng = numpy.random.RandomState(seed)
+    y = tensor.lvector('y')
+    y_hat = tensor.matrix('y_hat')
+    x = tensor.tensor4('x')
+    outer_fn = theano.function([y, y_hat, x],
+            outer_product_confusion_image(y, y_hat, x))
+    onehot_fn = theano.function([y, y_hat, x],
+            ConfusionImage().apply(y, y_hat, x))
+    for name, shape in [('mnist', (500, 1, 28, 28)),
+                        ('cifar', (128, 3, 32, 32))]:
+        inputs = (rng.randint(10, size=shape[0]),
+                rng.uniform(size=(shape[0], 10)).astype(theano.config.floatX),
+                rng.uniform(size=shape).astype(theano.config.floatX))
+        expected, outer_time = timed(lambda: outer_fn(*inputs), repeat)
+        actual, onehot_time = timed(lambda: onehot_fn(*inputs), repeat)
+        report('confusion image, %s batch %s' % (name, shape), OrderedDict([
+            ('outer product (ms)', '%.2f' % (outer_time * 1e3)),
+            ('one-hot matmul (ms)', '%.2f' % (onehot_time * 1e3)),
+            ('max difference', '%.2g' % numpy.abs(actual - expected).max())]))
+
+MAXACT_LAYERS = OrderedDict([
+    ('lenet', (365, [(6, 24, 24), (16, 8, 8), 120, 84])),
+    ('allconv', (100, [(96, 32, 32), (96, 16, 16), (192, 16, 16),
+                       (192, 8, 8), (10, 8, 8)])),
+])
+
+def bench_maxact(repeat=20, topn=100, snapshot_size=7, seed=1, **kwargs):
+    """Per-batch time of the MaximumActivationSearch used by view.py, for
+    the layer shapes of LeNet on MNIST and AllConvNet on CIFAR, keeping
+    whole activation maps versus cropped windows."""
+    from theano import tensor
+    import theano
+    from intent.maxact import MaximumActivationSearch
+    rng = numpy.random.RandomState(seed)
+    for name, (batch_size, layer_dims) in MAXACT_LAYERS.items():
+        names = ['layer%d' % i for i in range(len(layer_dims))]
+        batches = [OrderedDict((n, rng.normal(size=(batch_size,) + (
+            dims if isinstance(dims, tuple) else (dims,))).astype(
+                theano.config.floatX)) for n, dims in zip(names, layer_dims))
+            for _ in range(repeat)]
+        timings = OrderedDict()
+        for method, snapshot_shape in [
+                ('whole maps', None),
+                ('cropped', (snapshot_size, snapshot_size))]:
+            outputs = [tensor.TensorType(theano.config.floatX,
+                (False,) * (1 + (len(dims) if isinstance(dims, tuple) else 1))
+                )(n) for n, dims in zip(names, layer_dims)]
+            algorithm = MaximumActivationSearch(outputs=outputs,
+                    dims=dict(zip(outputs, layer_dims)), topn=topn,
+                    snapshot_shape=snapshot_shape)
+            algorithm.initialize()
+            start = time.perf_counter()
+            for batch in batches:
+                algorithm.process_batch(batch)
+            timings[method + ' (ms/batch)'] = '%.2f' % (
+                    (time.perf_counter() - start) / repeat * 1e3)
+        report('maxact, %s batch %d' % (name, batch_size), timings)
+
+def bench_masks(repeat=20, seed=1, **kwargs):
+    """make_masks versus one make_mask call per (example, unit), for the
+    LeNet convolutional layers as rendered by view.py and show.py."""
+    from intent.rf import make_mask
+    from intent.rf import make_masks
+    rng = numpy.random.RandomState(seed)
+    for name, fieldmap, map_shape in [
+            ('conv 1', ((0, 0), (5, 5), (1, 1)), (24, 24)),
+            ('conv 2', ((0, 0), (16, 16), (2, 2)), (8, 8))]:
+        stack = numpy.clip(rng.normal(size=(100, 16) + map_shape), 0, None)
+        def per_call():
+            return numpy.array([[make_mask((28, 28), fieldmap, stack[i, u])
+                for u in range(stack.shape[1])] for i in range(len(stack))])
+        expected, loop_time = timed(per_call, max(1, repeat // 10))
+        actual, batch_time = timed(
+                lambda: make_masks((28, 28), fieldmap, stack),
+                max(1, repeat // 10))
+        report('masks, %s, %s maps' % (name, stack.shape[:2]), OrderedDict([
+            ('per call (ms)', '%.1f' % (loop_time * 1e3)),
+            ('batched (ms)', '%.1f' % (batch_time * 1e3)),
+            ('identical', (actual == expected).all())]))
+
+def bench_pad_crop(repeat=20, batch_size=128, pad=4, seed=1, **kwargs):
+    """Padded random crops of a CIFAR batch as in RandomPadCropFlip,
+    numpy.pad per batch versus a reused padded buffer, and the strided
+    NumPy crop versus the compiled window_batch_bchw when it is built."""
+    from intent.transform import crop_flip_views
+    from intent.transform import window_batch_bchw_available
+    from intent.transform import window_batch_strided
+    rng = numpy.random.RandomState(seed)
+    batch = rng.normal(size=(batch_size, 3, 32, 32)).astype('float32')
+    offsets_h = rng.randint(0, 2 * pad + 1, size=batch_size)
+    offsets_w = rng.randint(0, 2 * pad + 1, size=batch_size)
+    out = numpy.empty(batch.shape, dtype=batch.dtype)
+    padded = numpy.zeros(batch.shape[:2] + (32 + 2 * pad, 32 + 2 * pad),
+            dtype=batch.dtype)
+    def numpy_pad():
+        symmetric = (pad, pad)
+        return numpy.pad(batch, ((0, 0), (0, 0), symmetric, symmetric),
+                'constant')
+    def reused_pad():
+        padded[:, :, pad:pad + 32, pad:pad + 32] = batch
+        return padded
+    def views(source, offsets_h, offsets_w, out):
+        crop_flip_views(source, offsets_h, offsets_w,
+                numpy.zeros(batch_size, dtype=bool), out)
+    crops = OrderedDict([('strided', window_batch_strided),
+                         ('per-image views', views)])
+    if window_batch_bchw_available:
+        from intent.transform import window_batch_bchw
+        crops['compiled'] = window_batch_bchw
+    timings = OrderedDict()
+    results = []
+    for pad_name, pad_fn in [('numpy.pad', numpy_pad),
+                             ('reused buffer', reused_pad)]:
+        for crop_name, crop_fn in crops.items():
+            def run():
+                crop_fn(pad_fn(), offsets_h, offsets_w, out)
+                return out.copy()
+            result, seconds = timed(run, repeat)
+            results.append(result)
+            timings['%s, %s (ms)' % (pad_name, crop_name)] = (
+                    '%.3f' % (seconds * 1e3))
+    timings['identical'] = all((r == results[0]).all() for r in results)
+    report('pad crop, batch %s' % (batch.shape,), timings)
+
+def bench_hdf5_read(repeat=3, batch_size=128, examples=10000, seed=1,
+        **kwargs):
+    """One epoch of reads of CIFAR-sized batches from an HDF5 file, with
+    ShuffledScheme versus SortedShuffledScheme, and the time to generate
+    the requests of SampledScheme, listed versus vectorized."""
+    import h5py
+    from fuel.datasets.hdf5 import H5PYDataset
+    from fuel.schemes import ShuffledScheme
+    from fuel.streams import DataStream
+    from intent.noisy import SampledScheme
+    from intent.noisy import SortedShuffledScheme
+    rng = numpy.random.RandomState(seed)
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'bench.hdf5')
+        with h5py.File(filename, mode='w') as f:
+            f.create_dataset('features', data=rng.randint(256,
+                size=(examples, 3, 32, 32)).astype('uint8'))
+            f.create_dataset('targets', data=rng.randint(10,
+                size=(examples, 1)).astype('uint8'))
+            f.attrs['split'] = H5PYDataset.create_split_array({'train': {
+                'features': (0, examples), 'targets': (0, examples)}})
+        dataset = H5PYDataset(filename, which_sets=('train',))
+        def read(scheme):
+            stream = DataStream(dataset, iteration_scheme=scheme)
+            return [batch[1].ravel()
+                    for batch in stream.get_epoch_iterator()]
+        timings = OrderedDict()
+        results = []
+        for name, scheme in [
+                ('shuffled', ShuffledScheme(examples, batch_size,
+                    rng=numpy.random.RandomState(seed))),
+                ('sorted', SortedShuffledScheme(examples, batch_size,
+                    rng=numpy.random.RandomState(seed)))]:
+            result, seconds = timed(lambda: read(scheme), repeat)
+            results.append(numpy.sort(numpy.concatenate(result)))
+            timings['%s (examples/s)' % name] = '%.0f' % (
+                    examples / seconds)
+        timings['same examples'] = (results[0] == results[1]).all()
+    finally:
+        shutil.rmtree(directory)
+    scheme = SampledScheme(examples, batch_size,
+            rng=numpy.random.RandomState(seed))
+    def listed():
+        indices = scheme.rng.choice(list(scheme.indices), examples)
+        return [list(indices[start:start + batch_size])
+                for start in range(0, examples, batch_size)]
+    def vectorized():
+        return list(scheme.get_request_iterator())
+    for name, fn in [('listed', listed), ('vectorized', vectorized)]:
+        scheme.rng.seed(seed)
+        result, seconds = timed(fn, repeat)
+        timings['%s requests (ms)' % name] = '%.3f' % (seconds * 1e3)
+    report('hdf5 read, %d examples, batch %d' % (examples, batch_size),
+            timings)
+
+def bench_noise(repeat=20, batch_size=64, seed=1, **kwargs):
+    """A training step of the noisy all-convolutional net of narun.py,
+    with noise resampled into buffers by the update NoiseExtension adds
+    versus sampled inline, and the memory the buffers take."""
+    from theano import tensor
+    import theano
+    from blocks.graph import ComputationGraph
+    from blocks.filter import VariableFilter
+    from intent.allconv import create_noisy_all_conv_net
+    from intent.noisy import NOISE
+    from intent.noisy import UnitNoiseGenerator
+    from intent.noisy import training_noise
+    rng = numpy.random.RandomState(seed)
+    features = rng.normal(size=(batch_size, 3, 32, 32)).astype(
+            theano.config.floatX)
+    timings = OrderedDict()
+    for name, noise_batch_size in [('buffers', batch_size),
+                                   ('inline', None)]:
+        convnet = create_noisy_all_conv_net(noise_batch_size, True)
+        x = tensor.tensor4('features')
+        with training_noise(convnet):
+            cost = -tensor.log(convnet.apply(x)[:, 0]).mean()
+        cg = ComputationGraph([cost])
+        noise_parameters = VariableFilter(roles=[NOISE])(cg.parameters)
+        parameters = [p for p in cg.parameters
+                if p not in noise_parameters]
+        updates = [(p, p - 0.001 * g) for p, g in
+                zip(parameters, tensor.grad(cost, parameters))]
+        generator = UnitNoiseGenerator(theano_seed=seed)
+        updates.extend((p, generator.apply(p)) for p in noise_parameters)
+        step = theano.function([x], cost, updates=updates)
+        result, seconds = timed(lambda: step(features), repeat)
+        timings['%s step (ms)' % name] = '%.3f' % (seconds * 1e3)
+        timings['%s buffers (MB)' % name] = '%.1f' % (sum(
+            p.get_value(borrow=True).nbytes for p in noise_parameters)
+            / 2.0 ** 20)
+    report('noise, batch %d' % batch_size, timings)
+
+BENCHMARKS = OrderedDict([
+    ('ablation', bench_ablation),
+    ('confusion-image', bench_confusion_image),
+    ('hdf5-read', bench_hdf5_read),
+    ('maxact', bench_maxact),
+    ('masks', bench_masks),
+    ('noise', bench_noise),
+    ('pad-crop', bench_pad_crop),
+])
+
+def main(benchmarks, **kwargs):
+    for name in benchmarks or BENCHMARKS:
+        BENCHMARKS[name](**kwargs)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = ArgumentParser("Benchmarks for net-intent analysis helpers.")
+    parser.add_argument("benchmarks", nargs="*",
+                        help="Benchmarks to run from %s, default all." %
+                             ', '.join(BENCHMARKS))
+    parser.add_argument("--samples", type=int, default=2000,
+                        help="Number of activation samples.")
+    parser.add_argument("--units", type=int, default=500,
+                        help="Number of units in the ablated layer.")
+    parser.add_argument("--ablated", type=int, default=5,
+                        help="Number of units removed per ablation query.")
+    parser.add_argument("--queries", type=int, default=20,
+                        help="Number of ablation queries timed.")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="Number of timed repetitions per measurement.")
+    args = parser.parse_args()
+    main(**vars(args))
@@ -48,9 +48,15 @@ from intent.ablation import ablate_inputs
 from intent.lenet import create_lenet_5
 from intent.maxact import MaximumActivationSearch
 from intent.filmstrip import Filmstrip
+from intent.filmstrip import compose_grid
+from intent.filmstrip import encode_image
+from intent.filmstrip import make_alpha_atlas
+from intent.filmstrip import make_sprite_atlas
+from intent.topk import cached_index
 from intent.scatter import Scatter
 from intent.rf import make_mask
 from intent.rf import layerarray_fieldmap
+from PIL import Image
 from prior import create_fair_basis
 from theano import gradient
 from theano import tensor
@@ -115,10 +121,28 @@ class MaxActivationTable(Brick):
         return tensor.concatenate(all_units, axis=1)
         # return all_units[1]
 
+def load_corpus_arrays(dataset):
+    """Reads every source of a dataset into contiguous in-memory arrays.
+
+    Returns a tuple of arrays in the order of dataset.sources, so that
+    lookups can be served by indexing rather than by an HDF5 read each.
+    """
+    state = dataset.open()
+    data = dataset.get_data(
+            state=state, request=slice(0, dataset.num_examples))
+    dataset.close(state=state)
+    return tuple(numpy.ascontiguousarray(d) for d in data)
+
 class BucketVisualizer:
     def __init__(self, save_to, act_table):
         self.mnist_test = MNIST(("test",), sources=['features', 'targets'])
+        self.features, self.targets = load_corpus_arrays(self.mnist_test)
+        # Pre-rendered tiles for grids (RGB) and for scatters (RGBA)
+        self.sprites = make_sprite_atlas(self.features)
+        self.alpha_sprites = make_alpha_atlas(self.features)
         self.table = self.load_act_table(save_to, act_table)
+        self.topk = cached_index(act_table + '.topk.npz', self.table,
+                newer_than=act_table)
 
     def all_match(self, index, the_set, positive):
         if the_set is None or len(the_set) == 0:
@@ -143,11 +167,16 @@ class BucketVisualizer:
         return self.table[index, :10].argmax()
 
     def label_for_sample(self, index):
-        return self.mnist_test.get_data(request=index)[1][0]
+        return self.targets[index, 0]
+
+    def images_for_samples(self, indexes):
+        """The grid tiles of the examples at indexes, in one fancy index."""
+        return self.sprites[numpy.asarray(indexes, dtype=numpy.int64)]
 
     def filter_image_bytes(self,
             positive_set=None, negative_set=None, sort_by=None,
-            columns=100, limit=None, ulimit=None, descending=False):
+            columns=100, limit=None, ulimit=None, descending=False,
+            format='PNG'):
         include_indexes = [ind for ind in range(self.table.shape[0])
                 if (self.all_match(ind, positive_set, True) and
                     self.all_match(ind, negative_set, False))]
@@ -163,11 +192,17 @@ class BucketVisualizer:
         count = max(1, len(include_indexes))
         grid_shape = (((count - 1) // columns + 1), min(columns, count))
 
-        filmstrip = Filmstrip(image_shape=(28, 28), grid_shape=grid_shape)
-        for i, index in enumerate(include_indexes):
-            filmstrip.set_image((i // columns, i % columns),
-                        self.mnist_test.get_data(request=index)[0])
-        return filmstrip.save_bytes()
+        tiles = self.images_for_samples(include_indexes)
+        return encode_image(compose_grid(tiles, grid_shape), format=format)
+
+    def top_image_bytes(self, unit, k=None, columns=100, format='PNG'):
+        """Grid of the examples that activate a unit most, best first."""
+        _, ids, _ = self.topk.top(unit, k)
+        ids = ids[ids >= 0]
+        count = max(1, len(ids))
+        grid_shape = (((count - 1) // columns + 1), min(columns, count))
+        return encode_image(compose_grid(self.images_for_samples(ids),
+                grid_shape), format=format)
 
     def example_count(self):
         return self.table.shape[0]
@@ -239,6 +274,25 @@ class BucketVisualizer:
         pickle.dump(table, open(act_table, 'wb'))
         return table
 
+# Encodings that may be requested with the format= query field.
+IMAGE_FORMATS = OrderedDict([
+    ('png', ('PNG', 'image/png')),
+    ('jpeg', ('JPEG', 'image/jpeg')),
+    ('jpg', ('JPEG', 'image/jpeg')),
+    ('webp', ('WEBP', 'image/webp')),
+])
+
+def supported_image_formats():
+    """The IMAGE_FORMATS this PIL build can encode; WEBP is optional."""
+    Image.init()
+    return OrderedDict((name, value) for name, value in IMAGE_FORMATS.items()
+            if value[0] in Image.SAVE)
+
+def image_format(fields):
+    """The (PIL format, content type) asked for by the format= field, or
+    None if this PIL build cannot encode it."""
+    return supported_image_formats().get(fields.get('format', 'png').lower())
+
 class QueryHTTPServer(HTTPServer):
     def __init__(self, tester, *args, **kw):
         super(QueryHTTPServer, self).__init__(*args, **kw)
@@ -263,6 +317,10 @@ class QueryRequestHandler(BaseHTTPRequestHandler):
         fields.update(urlparse.parse_qsl(field_data))
         self.dispatch(url, fields)
 
+    def send_format_error(self, fields):
+        self.send_error(400, "Unsupported format {}; expected one of {}".format(
+            fields['format'], ', '.join(supported_image_formats())))
+
     def dispatch(self, url, fields):
         if url.path == '/bucket':
             self.bucket(url, fields)
@@ -279,6 +337,9 @@ class QueryRequestHandler(BaseHTTPRequestHandler):
         if url.path == '/scatter':
             self.scatter(url, fields)
             return
+        if url.path == '/top':
+            self.top(url, fields)
+            return
 
         # Send response status code
         self.send_response(200)
@@ -385,10 +446,33 @@ class QueryRequestHandler(BaseHTTPRequestHandler):
         descending = False
         if 'descending' in fields:
             descending = True
+        if image_format(fields) is None:
+            self.send_format_error(fields)
+            return
+        format, content_type = image_format(fields)
         result = self.server.tester.filter_image_bytes(
-                positive, negative, sort_by, columns, limit, ulimit, descending)
+                positive, negative, sort_by, columns, limit, ulimit, descending,
+                format)
         self.send_response(200)
-        self.send_header('Content-type', 'image/png')
+        self.send_header('Content-type', content_type)
+        self.end_headers()
+        self.wfile.write(result)
+
+    def top(self, url, fields):
+        unit = int(fields.get('unit', 0))
+        k = None
+        if 'k' in fields:
+            k = int(fields['k'])
+        columns = 100
+        if 'columns' in fields:
+            columns = int(fields['columns'])
+        if image_format(fields) is None:
+            self.send_format_error(fields)
+            return
+        format, content_type = image_format(fields)
+        result = self.server.tester.top_image_bytes(unit, k, columns, format)
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
         self.end_headers()
         self.wfile.write(result)
 
@@ -399,14 +483,34 @@ class QueryRequestHandler(BaseHTTPRequestHandler):
         size = [1024, 1024]
         if 'size' in fields:
             size = [int(u) for u in fields['size'].split(',')]
-        scatter = Scatter(shape=size, unit_shape=(28, 28))
+        # Level of detail: one image per cell of this many pixels
+        cell_size = 14
+        if 'cell' in fields:
+            cell_size = int(fields['cell'])
+        # Zoomed tiles: at zoom z the plot is split into 2**z by 2**z tiles
+        viewport = None
+        margin = None
+        if 'zoom' in fields:
+            tiles = 2 ** int(fields['zoom'])
+            row, col = 0, 0
+            if 'tile' in fields:
+                row, col = [int(u) for u in fields['tile'].split(',')]
+            viewport = (row / tiles, col / tiles,
+                    (row + 1) / tiles, (col + 1) / tiles)
+            margin = (0, 0)
+        if image_format(fields) is None:
+            self.send_format_error(fields)
+            return
+        format, content_type = image_format(fields)
+        scatter = Scatter(shape=size, unit_shape=(28, 28), margin=margin)
         scatter.plot_scatter(
-                corpus=self.server.tester.mnist_test,
-                locations=self.server.tester.table[:, units])
+                sprites=self.server.tester.alpha_sprites,
+                locations=self.server.tester.table[:, units],
+                viewport=viewport, cell_size=cell_size)
         self.send_response(200)
-        self.send_header('Content-type', 'image/png')
+        self.send_header('Content-type', content_type)
         self.end_headers()
-        self.wfile.write(scatter.save_bytes())
+        self.wfile.write(scatter.save_bytes(format=format))
 
 
 if __name__ == "__main__":
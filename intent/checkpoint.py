@@ -1,10 +1,24 @@
 from blocks.extensions.saveload import Checkpoint
+import contextlib
 
 class EpochCheckpoint(Checkpoint):
+    """Checkpoint that names each file by epoch when the path has '%d'.
+
+    The arrays of any device_datasets, DeviceDatasets that the training
+    function reads, are left out of the saved main loop.  Load restores
+    only the parameters, log and iteration state, so they are not needed
+    to resume.
+    """
+    def __init__(self, path, device_datasets=(), **kwargs):
+        self.device_datasets = device_datasets
+        super().__init__(path, **kwargs)
+
     def do(self, callback_name, *args):
         if '%d' in self.path:
             epoch_path = self.path % self.main_loop.status['epochs_done']
         else:
             epoch_path = self.path
-        super().do(callback_name, epoch_path)
-
+        with contextlib.ExitStack() as stack:
+            for dataset in self.device_datasets:
+                stack.enter_context(dataset.detached())
+            super().do(callback_name, epoch_path)
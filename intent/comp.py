@@ -37,6 +37,7 @@ from fuel.streams import DataStream
 from intent.lenet import LeNet, create_lenet_5
 from intent.actpic import ActpicExtension
 from intent.synpic import SynpicExtension, CasewiseCrossEntropy
+from intent.noisy import SortedShuffledScheme
 from collections import OrderedDict
 from filmstrip import Filmstrip
 from filmstrip import plan_grid
@@ -207,7 +208,7 @@ def create_main_loop(save_to, num_epochs, unit_order=None,
 
     mnist_train = MNIST(("train",))
     mnist_train_stream = DataStream.default_stream(
-        mnist_train, iteration_scheme=ShuffledScheme(
+        mnist_train, iteration_scheme=SortedShuffledScheme(
             mnist_train.num_examples, batch_size))
 
     mnist_test = MNIST(("test",))
@@ -31,6 +31,7 @@ from blocks.roles import WEIGHT
 from blocks.roles import OUTPUT
 from blocks_extras.extensions.plot import Plot  
 from fuel.datasets import CIFAR10
+from fuel.schemes import SequentialScheme
 from fuel.schemes import ShuffledScheme
 from fuel.streams import DataStream
 from fuel.transformers.image import RandomFixedSizeCrop
@@ -40,10 +41,17 @@ from intent.attrib import print_attributions
 from intent.attrib import save_attributions
 from intent.ablation import ConfusionMatrix
 from intent.ablation import Sum
+from intent.memdata import corpus
 from intent.transform import RandomFlip
 from intent.transform import RandomPadCropFlip
 from intent.transform import NormalizeBatchLevels
+from intent.transform import cached_level_statistics
+from intent.transform import normalized_levels
+from intent.noisy import SortedShuffledScheme
+from intent.prefetch import DataWaitFraction
+from intent.prefetch import augmented_stream
 from intent.schedule import EpochSchedule
+import functools
 import json
 from json import JSONEncoder, dumps
 import numpy
@@ -52,7 +60,9 @@ import numpy
 
 def main(save_to, num_epochs,
          regularization=0.001, subset=None, num_batches=None,
-         batch_size=None, histogram=None, resume=False):
+         batch_size=None, histogram=None, resume=False,
+         workers=0, levels_file=None, memmap=None,
+         block_size=None):
     output_size = 10
     convnet = create_all_conv_net()
 
@@ -108,25 +118,34 @@ def main(save_to, num_epochs,
     train_cost = train_cost + regularization * l2_norm
     train_cost.name = 'cost_with_regularization'
 
-    cifar10_train = CIFAR10(("train",))
+    Corpus = corpus(CIFAR10, memmap)
+    cifar10_train = Corpus(("train",))
+    levels = None
+    if levels_file:
+        levels = cached_level_statistics(levels_file,
+            DataStream.default_stream(cifar10_train,
+                iteration_scheme=SequentialScheme(
+                    cifar10_train.num_examples, 1000)))
     #cifar10_train_stream = RandomPadCropFlip(
     #    NormalizeBatchLevels(DataStream.default_stream(
     #        cifar10_train, iteration_scheme=ShuffledScheme(
     #            cifar10_train.num_examples, batch_size)),
     #    which_sources=('features',)),
     #    (32, 32), pad=5, which_sources=('features',))
-    cifar10_train_stream = NormalizeBatchLevels(DataStream.default_stream(
-            cifar10_train, iteration_scheme=ShuffledScheme(
-                cifar10_train.num_examples, batch_size)),
-        which_sources=('features',))
+    cifar10_train_stream = augmented_stream(
+        cifar10_train,
+        SortedShuffledScheme(cifar10_train.num_examples, batch_size,
+            block_size=block_size),
+        functools.partial(normalized_levels, levels=levels),
+        workers=workers)
 
     test_batch_size = 1000
-    cifar10_test = CIFAR10(("test",))
-    cifar10_test_stream = NormalizeBatchLevels(DataStream.default_stream(
+    cifar10_test = Corpus(("test",))
+    cifar10_test_stream = normalized_levels(DataStream.default_stream(
         cifar10_test,
         iteration_scheme=ShuffledScheme(
             cifar10_test.num_examples, test_batch_size)),
-        which_sources=('features',))
+        levels=levels)
 
     momentum = Momentum(0.002, 0.9)
 
@@ -199,6 +218,9 @@ def main(save_to, num_epochs,
     if resume:
         extensions.append(Load(save_to, True, True))
 
+    if workers:
+        extensions.insert(1, DataWaitFraction())
+
     model = Model(train_cost)
 
     main_loop = MainLoop(
@@ -243,6 +265,20 @@ if __name__ == "__main__":
                         help="Size of limited training set.")
     parser.add_argument('--resume', dest='resume', action='store_true')
     parser.add_argument('--no-resume', dest='resume', action='store_false')
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Processes augmenting the training data, "
+                             "default 0 to augment in the training "
+                             "process.")
+    parser.add_argument('--levels', dest='levels_file', default=None,
+                        help="File caching the channel statistics of the "
+                             "training set, to normalize by instead of by "
+                             "batch.")
+    parser.add_argument('--memmap', default=None,
+                        help="Directory of arrays written by memdata.py to "
+                             "read instead of the Fuel dataset.")
+    parser.add_argument('--block-size', type=int, default=None,
+                        help="Read the shuffled training set in contiguous "
+                             "blocks of this many examples.")
     parser.set_defaults(resume=False)
     args = parser.parse_args()
     main(**vars(args))
@@ -32,6 +32,82 @@ def plan_grid(unit_count, aspect_ratio, image_shape=None,
     column_count = int(numpy.ceil(unit_count / column_height))
     return (column_height, column_count)
 
+def make_sprite_atlas(image_data, overflow_color=1):
+    """Renders a stack of images as a uint8 (N, H, W, 3) RGB sprite atlas.
+
+    Each sprite matches what Filmstrip.set_image would paint for the same
+    image with default arguments, so grids can be composed from the atlas
+    by indexing instead of converting one tile at a time.
+    """
+    if len(image_data.shape) == 3:
+        image_data = image_data[:, numpy.newaxis, :, :]
+    unit_range = not numpy.issubdtype(image_data.dtype, numpy.integer)
+    negative = image_data.shape[1] == 1
+    if image_data.shape[1] == 1:
+        if unit_range:
+            high_data = (image_data - 1).clip(0, 1)
+            low_data = (- image_data).clip(0, 1)
+            image_data = numpy.repeat(image_data.clip(0, 1), 3, axis=1)
+            image_data[:, overflow_color, :, :] += low_data[:, 0, :, :]
+            image_data[:, overflow_color, :, :] -= high_data[:, 0, :, :]
+        else:
+            image_data = numpy.repeat(image_data, 3, axis=1)
+    if unit_range:
+        image_data = numpy.clip(image_data * 255, 0, 255)
+    if negative:
+        image_data = 255 - image_data
+    return numpy.ascontiguousarray(
+            image_data.transpose((0, 2, 3, 1)).astype(numpy.uint8))
+
+def make_alpha_atlas(image_data):
+    """Renders a stack of single-channel images as (N, H, W, 4) RGBA sprites.
+
+    The image intensity becomes the alpha channel over black, which is
+    how Scatter.set_image paints a two-dimensional image.
+    """
+    if len(image_data.shape) == 4:
+        image_data = image_data[:, 0, :, :]
+    if not numpy.issubdtype(image_data.dtype, numpy.integer):
+        image_data = numpy.clip(image_data * 255, 0, 255)
+    atlas = numpy.zeros(image_data.shape + (4,), dtype=numpy.uint8)
+    atlas[:, :, :, 3] = image_data
+    return atlas
+
+def compose_grid(tiles, grid_shape, margin=1, background=(255, 255, 255)):
+    """Lays out a (N, H, W, 3) uint8 tile stack row-major on a grid.
+
+    Returns a single image array with the same layout that Filmstrip
+    produces, filling unused cells and margins with the background.
+    """
+    rows, columns = grid_shape
+    count, height, width, depth = tiles.shape
+    cells = numpy.empty((rows * columns, height + margin, width + margin,
+                depth), dtype=numpy.uint8)
+    cells[...] = background
+    cells[:count, :height, :width, :] = tiles[:rows * columns]
+    grid = cells.reshape(
+            (rows, columns, height + margin, width + margin, depth)
+            ).transpose((0, 2, 1, 3, 4)).reshape(
+            (rows * (height + margin), columns * (width + margin), depth))
+    return grid[:rows * (height + margin) - margin,
+                :columns * (width + margin) - margin]
+
+def scale_tiles(tiles, tile_shape):
+    """Resizes a (N, H, W, ...) tile stack to tile_shape by nearest
+    neighbor sampling, so crops of any field size share one grid."""
+    rows = numpy.arange(tile_shape[0]) * tiles.shape[1] // tile_shape[0]
+    cols = numpy.arange(tile_shape[1]) * tiles.shape[2] // tile_shape[1]
+    return tiles[:, rows[:, None], cols[None, :]]
+
+def encode_image(image_data, format='PNG', quality=90):
+    """Encodes an (H, W, 3) uint8 array as image file bytes."""
+    output = io.BytesIO()
+    opts = { 'quality': quality } if format in ('JPEG', 'WEBP') else {}
+    Image.fromarray(image_data).save(output, format=format, **opts)
+    contents = output.getvalue()
+    output.close()
+    return contents
+
 class Filmstrip:
     def __init__(self, image_shape=None, grid_shape=None,
                     margin=1, background='white'):
@@ -7,6 +7,7 @@ from blocks.filter import get_brick
 from blocks.roles import PersistentRole
 from blocks.roles import add_role
 from blocks.utils import shared_floatx_zeros
+from theano.ifelse import ifelse
 import theano
 import numpy
 import numbers
@@ -69,7 +70,8 @@ def _apply_index(data, indices, axis=0):
             _axis_count(shape, a - 1, ndim - 1)
             for a in range(ndim))]
 
-def _create_maximum_activation_for(output, topn, dims=None):
+def _create_maximum_activation_for(output, topn, dims=None,
+        snapshot_shape=None):
     # Automatically compute the number of units
     if dims is None:
         dims = get_brick(output).get_dims(['output'])[0]
@@ -79,7 +81,8 @@ def _create_maximum_activation_for(output, topn, dims=None):
         snapshot = None
     else:
         index = theano.shared(numpy.zeros((topn, dims[0], 3), dtype=numpy.int))
-        snapshot = theano.shared(numpy.zeros((topn,) + dims))
+        snapshot = theano.shared(numpy.zeros(
+            (topn, dims[0]) + tuple(snapshot_shape or dims[1:])))
 
     quantity = shared_floatx_zeros((topn, dims[0]))
 
@@ -90,18 +93,52 @@ def _create_maximum_activation_for(output, topn, dims=None):
 
     return (dims, quantity, index, snapshot)
 
-def _create_maximum_activation_update(output, record, streamindex, topn):
+def _crop_windows(maps, locations, window):
+    """
+    Crops a window of each unit's activation map around a location.
+
+    maps is a (cases, units, height, width) tensor, and locations is a
+    pair of (cases, units) tensors of row and column.  The result is
+    (cases, units) + window, zero-padded beyond the edge of the map.
+    """
+    h, w = window
+    padded = tensor.zeros((maps.shape[0], maps.shape[1],
+        maps.shape[2] + h - 1, maps.shape[3] + w - 1), dtype=maps.dtype)
+    padded = tensor.set_subtensor(padded[:, :,
+        h // 2:h // 2 + maps.shape[2], w // 2:w // 2 + maps.shape[3]], maps)
+    # In padded coordinates, the window centered at y starts at y
+    rows = (locations[0].dimshuffle(0, 1, 'x', 'x') +
+            tensor.arange(h).dimshuffle('x', 'x', 0, 'x'))
+    cols = (locations[1].dimshuffle(0, 1, 'x', 'x') +
+            tensor.arange(w).dimshuffle('x', 'x', 'x', 0))
+    return padded[_axis_count(padded.shape, 0, 4),
+            _axis_count(padded.shape, 1, 4), rows, cols]
+
+def uncrop_snapshot(snapshot, location, map_shape):
+    """Places a cropped snapshot back into a zero activation map of
+    map_shape, centered at its (row, col) maximum location."""
+    result = numpy.zeros(map_shape, dtype=snapshot.dtype)
+    corner = [l - s // 2 for l, s in zip(location, snapshot.shape)]
+    target = tuple(slice(max(c, 0), min(c + s, m))
+            for c, s, m in zip(corner, snapshot.shape, map_shape))
+    source = tuple(slice(t.start - c, t.stop - c)
+            for t, c in zip(target, corner))
+    result[target] = snapshot[source]
+    return result
+
+def _create_maximum_activation_update(output, record, streamindex, topn,
+        snapshot_shape=None):
     """
     Calculates update of the topn maximums for one batch of outputs.
+
+    Only the batch's own top candidates for each unit are merged with the
+    running maximums, and the whole merge is skipped when no activation
+    in the batch exceeds the current topn-th maximum of its unit.
     """
     dims, maximums, indices, snapshot = record
-    counters = tensor.tile(tensor.shape_padright(
-        tensor.arange(output.shape[0]) + streamindex), (1, output.shape[1]))
     if len(dims) == 1:
         # output is a 2d tensor, (cases, units) -> activation
         tmax = output
-        # counters is a 2d tensor broadcastable (cases, units) -> case_index
-        tind = counters
     else:
         # output is a 4d tensor: fmax flattens it to 3d
         fmax = output.flatten(ndim=3)
@@ -109,22 +146,38 @@ def _create_maximum_activation_update(output, record, streamindex, topn):
         fargmax = fmax.argmax(axis=2)
         # fetch the maximum. tmax is 2d, (cases, units) -> activation
         tmax = _apply_index(fmax, fargmax, axis=2)
+    # Partial selection: bargsort is the batch's own top k for each unit
+    bargsort = (-tmax).argsort(axis=0)[:topn]
+    bmax = _apply_perm(tmax, bargsort, axis=0)
+    # bcounters is a 2d tensor (k, units) -> case_index
+    bcounters = bargsort + streamindex
+    if len(dims) == 1:
+        bind = bcounters
+    else:
         # targmax is a tuple that separates rolled-up location into (x, y)
-        targmax = divmod(fargmax, dims[2])
-        # tind is a 3d tensor (cases, units, 3) -> case_index, maxloc
+        targmax = divmod(_apply_perm(fargmax, bargsort, axis=0), dims[2])
+        # bind is a 3d tensor (k, units, 3) -> case_index, maxloc
         # this will match indices which is a 3d tensor also
-        tind = tensor.stack((counters, ) + targmax, axis=2)
-    cmax = tensor.concatenate((maximums, tmax), axis=0)
-    cind = tensor.concatenate((indices, tind), axis=0)
+        bind = tensor.stack((bcounters, ) + targmax, axis=2)
+    cmax = tensor.concatenate((maximums, bmax), axis=0)
+    cind = tensor.concatenate((indices, bind), axis=0)
     cargsort = (-cmax).argsort(axis=0)[:topn]
     newmax = _apply_perm(cmax, cargsort, axis=0)
     newind = _apply_perm(cind, cargsort, axis=0)
-    updates = [(maximums, newmax), (indices, newind)]
-    if snapshot:
-        csnap = tensor.concatenate((snapshot, output), axis=0)
-        newsnap = _apply_perm(csnap, cargsort, axis=0)
-        updates.append((snapshot, newsnap))
-    return updates
+    current = [maximums, indices]
+    merged = [newmax, newind]
+    if snapshot is not None:
+        # Only the maps of the batch's candidates are gathered and cropped
+        bsnap = _apply_perm(output, bargsort, axis=0)
+        if snapshot_shape is not None:
+            bsnap = _crop_windows(bsnap, targmax, snapshot_shape)
+        csnap = tensor.concatenate((snapshot, bsnap), axis=0)
+        current.append(snapshot)
+        merged.append(_apply_perm(csnap, cargsort, axis=0))
+    # The topn-th maximum of each unit is the threshold for entry
+    beats = (tmax > maximums[-1].dimshuffle('x', 0)).any()
+    updated = ifelse(beats, merged, current)
+    return list(zip(current, updated))
 
 class MaximumActivationSearch(UpdatesAlgorithm):
     """Algorithm for identifying maximum activations for individual neurons.
@@ -132,24 +185,35 @@ class MaximumActivationSearch(UpdatesAlgorithm):
     Parameters
     ----------
     outputs: list of variables that should be probed.
+    snapshot_shape: optional (height, width) window of each unit's
+        activation map to keep, centered at its maximum, instead of
+        the whole map, or a dict of windows by output, as from
+        rf.snapshot_window.
     """
 
-    def __init__(self, outputs=None, dims=None, topn=100, **kwargs):
+    def __init__(self, outputs=None, dims=None, topn=100,
+            snapshot_shape=None, **kwargs):
         self.outputs = outputs
         self.topn = topn
         self.dims = dims if dims is not None else {}
+        if not isinstance(snapshot_shape, dict):
+            snapshot_shape = dict((o, snapshot_shape) for o in outputs)
+        self.snapshot_shape = snapshot_shape
         # Represents the location within the datastream
         self.streamindex = theano.shared(numpy.zeros((), dtype=numpy.int64))
         super(MaximumActivationSearch, self).__init__(**kwargs)
 
         self.maximum_activations = OrderedDict(
             [(o, _create_maximum_activation_for(o, self.topn,
-                dims=self.dims.get(o, None))) for o in self.outputs])
+                dims=self.dims.get(o, None),
+                snapshot_shape=self.snapshot_shape.get(o)))
+                for o in self.outputs])
         self.maximum_activations_updates = []
         for o, record in self.maximum_activations.items():
             self.maximum_activations_updates.extend(
                 _create_maximum_activation_update(
-                    o, record, self.streamindex, self.topn))
+                    o, record, self.streamindex, self.topn,
+                    snapshot_shape=self.snapshot_shape.get(o)))
         self.maximum_activations_updates.append(
             (self.streamindex, self.streamindex + self.outputs[0].shape[0]))
         self.add_updates(self.maximum_activations_updates)
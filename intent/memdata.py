@@ -0,0 +1,159 @@
+"""Preprocessed datasets served from memory-mapped .npy files.
+
+Fuel's MNIST and CIFAR10 are read from HDF5 as uint8 and converted to
+floats batch by batch.  This converts each split once:
+
+```
+python memdata.py cifar10 --splits train test --directory data
+```
+
+and MemmapDataset then serves the float arrays from numpy.memmap, with
+requests for a contiguous run of examples answered by a slice of the
+map, without any copy.
+"""
+import functools
+import json
+import logging
+import os.path
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+from fuel.datasets import CIFAR10
+from fuel.datasets import Dataset
+from fuel.datasets import MNIST
+from fuel.schemes import SequentialScheme
+from fuel.streams import DataStream
+import numpy
+
+CORPORA = OrderedDict([
+    ('mnist', MNIST),
+    ('cifar10', CIFAR10),
+])
+
+def array_filename(directory, name, split, source):
+    return os.path.join(directory, '{}_{}_{}.npy'.format(name, split, source))
+
+def labels_filename(directory, name):
+    return os.path.join(directory, '{}_axis_labels.json'.format(name))
+
+def preprocess(name, split, directory, dtype='float32', batch_size=1000):
+    """Writes the default stream of one split of a corpus to .npy files,
+    with float sources converted to dtype, e.g., float32 or float16."""
+    dataset = CORPORA[name]((split,))
+    stream = DataStream.default_stream(dataset,
+            iteration_scheme=SequentialScheme(
+                dataset.num_examples, batch_size))
+    arrays = None
+    start = 0
+    for batch in stream.get_epoch_iterator(as_dict=True):
+        if arrays is None:
+            arrays = OrderedDict((source, numpy.lib.format.open_memmap(
+                array_filename(directory, name, split, source), mode='w+',
+                dtype=dtype if numpy.issubdtype(data.dtype, numpy.floating)
+                    else data.dtype,
+                shape=(dataset.num_examples,) + data.shape[1:]))
+                for source, data in batch.items())
+        for source, data in batch.items():
+            arrays[source][start:start + len(data)] = data
+        start += len(data)
+    for array in arrays.values():
+        array.flush()
+    with open(labels_filename(directory, name), 'w') as f:
+        json.dump(stream.axis_labels, f)
+    return arrays
+
+def as_slice(request):
+    """Turns a list of consecutive increasing indices into a slice."""
+    if (isinstance(request, list) and request and
+            request[-1] - request[0] == len(request) - 1 and
+            all(b - a == 1 for a, b in zip(request, request[1:]))):
+        return slice(request[0], request[-1] + 1)
+    return request
+
+class MemmapDataset(Dataset):
+    """A split written by preprocess, read through numpy.memmap.
+
+    Parameters
+    ----------
+    name : str
+        The corpus name, e.g., 'mnist' or 'cifar10'.
+    which_sets : tuple of str
+        The split to read, e.g., ('train',), as for the Fuel datasets.
+    directory : str
+        Where preprocess wrote the .npy files.
+    subset : slice, optional
+        A contiguous range of the split to serve.
+    """
+    def __init__(self, name, which_sets, directory='.', subset=None,
+            **kwargs):
+        if len(which_sets) != 1:
+            raise ValueError("MemmapDataset reads one split at a time")
+        self.name = name
+        self.split, = which_sets
+        self.directory = directory
+        self.subset = subset or slice(None)
+        with open(labels_filename(directory, name)) as f:
+            axis_labels = dict((source, tuple(labels))
+                    for source, labels in json.load(f).items())
+        self.provides_sources = tuple(sorted(axis_labels))
+        self.open()
+        kwargs.setdefault('axis_labels', axis_labels)
+        super(MemmapDataset, self).__init__(**kwargs)
+
+    def open(self):
+        self.data = dict((source, numpy.load(array_filename(
+            self.directory, self.name, self.split, source),
+            mmap_mode='r')[self.subset])
+            for source in self.provides_sources)
+
+    def __getstate__(self):
+        # Checkpoints should name the files, not copy their contents
+        state = self.__dict__.copy()
+        del state['data']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    @property
+    def num_examples(self):
+        return len(self.data[self.provides_sources[0]])
+
+    def get_data(self, state=None, request=None):
+        if state is not None:
+            raise ValueError("MemmapDataset does not have a state")
+        request = as_slice(request)
+        return tuple(self.data[source][request] for source in self.sources)
+
+def corpus(Corpus, directory=None):
+    """The Fuel dataset class Corpus, or when directory is given, a
+    constructor with the same arguments for its preprocessed arrays."""
+    if directory is None:
+        return Corpus
+    return functools.partial(MemmapDataset, Corpus.__name__.lower(),
+            directory=directory)
+
+def main(name, splits, directory, dtype):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for split in splits:
+        arrays = preprocess(name, split, directory, dtype)
+        logging.info("Wrote {} {}: {}".format(name, split, ', '.join(
+            '{} {} {}'.format(source, array.shape, array.dtype)
+            for source, array in arrays.items())))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = ArgumentParser("Preprocesses a dataset to memory-mapped arrays.")
+    parser.add_argument("name", choices=list(CORPORA),
+                        help="Dataset to convert.")
+    parser.add_argument("--splits", nargs="+", default=["train", "test"],
+                        help="Dataset splits to convert.")
+    parser.add_argument("--directory", default="data",
+                        help="Where to write the .npy files.")
+    parser.add_argument("--dtype", default="float32",
+                        choices=["float32", "float16"],
+                        help="Type to store the features as.")
+    args = parser.parse_args()
+    main(**vars(args))
@@ -32,6 +32,7 @@ from blocks.roles import WEIGHT
 from blocks.roles import OUTPUT
 from blocks_extras.extensions.plot import Plot  
 from fuel.datasets import CIFAR10
+from fuel.schemes import SequentialScheme
 from fuel.schemes import ShuffledScheme
 from fuel.streams import DataStream
 from fuel.transformers.image import RandomFixedSizeCrop
@@ -43,11 +44,19 @@ from intent.ablation import ConfusionMatrix
 from intent.ablation import Sum
 from intent.noisy import NITS, NOISE, LOG_SIGMA, NoiseExtension
 from intent.noisy import NoisyDataStreamMonitoring
+from intent.noisy import training_noise
 from intent.transform import RandomFlip
 from intent.transform import RandomPadCropFlip
 from intent.transform import NormalizeBatchLevels
+from intent.transform import cached_level_statistics
+from intent.transform import normalized_levels
+from intent.transform import padded_crop_flip
+from intent.noisy import SortedShuffledScheme
+from intent.prefetch import DataWaitFraction
+from intent.prefetch import augmented_stream
 from intent.schedule import EpochSchedule
 from intent.schedule import EpochExponentiation
+import functools
 import json
 from json import JSONEncoder, dumps
 import numpy
@@ -57,9 +66,13 @@ import numpy
 def main(save_to, num_epochs,
          subset=None, num_batches=None, batch_size=None,
          regularization=None, annealing=None,
-         histogram=None, resume=False):
+         histogram=None, resume=False,
+         workers=0, levels_file=None,
+         block_size=None, inline_noise=False):
     output_size = 10
-    convnet = create_noisy_all_conv_net(batch_size, True)
+    # Without a noise batch size, noise is sampled inline while training
+    convnet = create_noisy_all_conv_net(
+            None if inline_noise else batch_size, True)
 
     x = tensor.tensor4('features')
     y = tensor.lmatrix('targets')
@@ -93,10 +106,22 @@ def main(save_to, num_epochs,
     # Apply 0.2 dropout to the input, as in the paper
     # train_cg = apply_dropout(test_cg, [x], 0.2)
     # train_cg = drop_cg
-    train_cg = test_cg
-
-    train_cost, train_error_rate, train_components = (
-            test_cost, test_error_rate, test_components)
+    if inline_noise:
+        with training_noise(convnet):
+            train_probs = convnet.apply(x)
+        train_cost = (CategoricalCrossEntropy().apply(y.flatten(),
+                    train_probs).copy(name='cost'))
+        train_components = (ComponentwiseCrossEntropy().apply(y.flatten(),
+                    train_probs).copy(name='components'))
+        train_error_rate = (MisclassificationRate().apply(y.flatten(),
+                    train_probs).copy(name='error_rate'))
+        train_cg = ComputationGraph([train_cost,
+                    train_error_rate, train_components])
+    else:
+        train_cg = test_cg
+
+        train_cost, train_error_rate, train_components = (
+                test_cost, test_error_rate, test_components)
 
     # Apply regularization to the cost
 
@@ -107,11 +132,17 @@ def main(save_to, num_epochs,
     weights = VariableFilter(roles=[WEIGHT])(train_cg.variables)
     logsigma = VariableFilter(roles=[LOG_SIGMA])(train_cg.variables)
 
-    test_nits = VariableFilter(roles=[NITS])(train_cg.auxiliary_variables)
+    test_nits = VariableFilter(roles=[NITS])(test_cg.auxiliary_variables)
     test_nit_rate = tensor.concatenate([n.flatten() for n in test_nits]).mean()
     test_nit_rate.name = 'nit_rate'
 
     train_nit_rate = test_nit_rate
+    if inline_noise:
+        train_nits = VariableFilter(roles=[NITS])(
+                train_cg.auxiliary_variables)
+        train_nit_rate = tensor.concatenate(
+                [n.flatten() for n in train_nits]).mean()
+        train_nit_rate.name = 'nit_rate'
 
     l2_norm = sum([(W ** 2).sum() for W in weights])
     l2_norm.name = 'l2_norm'
@@ -135,23 +166,29 @@ def main(save_to, num_epochs,
     train_cost.name = 'cost_with_regularization'
 
     cifar10_train = CIFAR10(("train",))
-    cifar10_train_stream = RandomPadCropFlip(
-        NormalizeBatchLevels(DataStream.default_stream(
-            cifar10_train, iteration_scheme=ShuffledScheme(
-                cifar10_train.num_examples, batch_size)),
-        which_sources=('features',)),
-        (32, 32), pad=5, which_sources=('features',))
+    levels = None
+    if levels_file:
+        levels = cached_level_statistics(levels_file,
+            DataStream.default_stream(cifar10_train,
+                iteration_scheme=SequentialScheme(
+                    cifar10_train.num_examples, 1000)))
+    cifar10_train_stream = augmented_stream(
+        cifar10_train,
+        SortedShuffledScheme(cifar10_train.num_examples, batch_size,
+            block_size=block_size),
+        functools.partial(padded_crop_flip, pad=5, levels=levels),
+        workers=workers)
     # cifar10_train_stream = NormalizeBatchLevels(DataStream.default_stream(
     #        cifar10_train, iteration_scheme=ShuffledScheme(
     #             cifar10_train.num_examples, batch_size)),
     #     which_sources=('features',))
 
     cifar10_test = CIFAR10(("test",))
-    cifar10_test_stream = NormalizeBatchLevels(DataStream.default_stream(
+    cifar10_test_stream = normalized_levels(DataStream.default_stream(
         cifar10_test,
         iteration_scheme=ShuffledScheme(
             cifar10_test.num_examples, batch_size)),
-        which_sources=('features',))
+        levels=levels)
 
     momentum = Momentum(0.002, 0.9)
 
@@ -235,6 +272,9 @@ def main(save_to, num_epochs,
     if resume:
         extensions.append(Load(save_to, True, True))
 
+    if workers:
+        extensions.insert(1, DataWaitFraction())
+
     model = Model(train_cost)
 
     main_loop = MainLoop(
@@ -281,6 +321,20 @@ if __name__ == "__main__":
                         help="Size of limited training set.")
     parser.add_argument('--resume', dest='resume', action='store_true')
     parser.add_argument('--no-resume', dest='resume', action='store_false')
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Processes augmenting the training data, "
+                             "default 0 to augment in the training "
+                             "process.")
+    parser.add_argument('--levels', dest='levels_file', default=None,
+                        help="File caching the channel statistics of the "
+                             "training set, to normalize by instead of by "
+                             "batch.")
+    parser.add_argument('--block-size', type=int, default=None,
+                        help="Read the shuffled training set in contiguous "
+                             "blocks of this many examples.")
+    parser.add_argument('--inline-noise', action='store_true',
+                        help="Sample the noise inside the training graph "
+                             "instead of into buffers resampled each step.")
     parser.set_defaults(resume=False)
     args = parser.parse_args()
     main(**vars(args))
@@ -33,6 +33,7 @@ from blocks.roles import WEIGHT
 from blocks.roles import OUTPUT
 from blocks_extras.extensions.plot import Plot  
 from fuel.datasets import CIFAR10
+from fuel.schemes import SequentialScheme
 from fuel.schemes import ShuffledScheme
 from fuel.streams import DataStream
 from fuel.transformers.image import RandomFixedSizeCrop
@@ -48,8 +49,17 @@ from intent.noisy import training_noise
 from intent.transform import RandomFlip
 from intent.transform import RandomPadCropFlip
 from intent.transform import NormalizeBatchLevels
+from intent.transform import cached_level_statistics
+from intent.transform import normalized_levels
+from intent.transform import padded_crop_flip
+from intent.augment import DeviceDataset
+from intent.augment import PadCropFlip
+from intent.noisy import SortedShuffledScheme
+from intent.prefetch import DataWaitFraction
+from intent.prefetch import augmented_stream
 from intent.schedule import EpochSchedule
 from intent.checkpoint import EpochCheckpoint
+import functools
 import json
 from json import JSONEncoder, dumps
 import numpy
@@ -63,7 +73,9 @@ sys.setrecursionlimit(50000)
 
 def main(save_to, num_epochs,
          weight_decay=0.0001, noise_pressure=0, subset=None, num_batches=None,
-         batch_size=None, histogram=None, resume=False):
+         batch_size=None, histogram=None, resume=False,
+         workers=0, levels_file=None, on_device=False,
+         block_size=None):
     output_size = 10
 
     prior_noise_level = -10
@@ -107,14 +119,31 @@ def main(save_to, num_epochs,
 
     # train_cost, train_error_rate, train_components = train_cg.outputs
 
+    cifar10_train = CIFAR10(("train",))
+    levels = None
+    if levels_file:
+        levels = cached_level_statistics(levels_file,
+            DataStream.default_stream(cifar10_train,
+                iteration_scheme=SequentialScheme(
+                    cifar10_train.num_examples, 1000)))
+    train_x, train_y = x, y
+    device_datasets = []
+    if on_device:
+        # Only the indices of a batch are sent to the device
+        device = DeviceDataset(cifar10_train)
+        device_datasets.append(device)
+        train_x, train_y = device.batch(
+                tensor.lvector('indices'), levels=levels)
+        train_x = PadCropFlip((32, 32), pad=4).apply(train_x)
+
     with batch_normalization(convnet):
         with training_noise(convnet):
-            train_probs = convnet.apply(x)
-    train_cost = (CategoricalCrossEntropy().apply(y.flatten(), train_probs)
-                .copy(name='cost'))
-    train_components = (ComponentwiseCrossEntropy().apply(y.flatten(),
+            train_probs = convnet.apply(train_x)
+    train_cost = (CategoricalCrossEntropy().apply(train_y.flatten(),
+                train_probs).copy(name='cost'))
+    train_components = (ComponentwiseCrossEntropy().apply(train_y.flatten(),
                 train_probs).copy(name='components'))
-    train_error_rate = (MisclassificationRate().apply(y.flatten(),
+    train_error_rate = (MisclassificationRate().apply(train_y.flatten(),
                 train_probs).copy(name='error_rate'))
     train_cg = ComputationGraph([train_cost,
                 train_error_rate, train_components])
@@ -161,21 +190,24 @@ def main(save_to, num_epochs,
     train_cost = train_cost + l2_regularization + train_nit_regularization
     train_cost.name = 'cost_with_regularization'
 
-    cifar10_train = CIFAR10(("train",))
-    cifar10_train_stream = RandomPadCropFlip(
-        NormalizeBatchLevels(DataStream.default_stream(
-            cifar10_train, iteration_scheme=ShuffledScheme(
-                cifar10_train.num_examples, batch_size)),
-        which_sources=('features',)),
-        (32, 32), pad=4, which_sources=('features',))
+    if on_device:
+        cifar10_train_stream = device.index_stream(
+            ShuffledScheme(device.num_examples, batch_size))
+    else:
+        cifar10_train_stream = augmented_stream(
+            cifar10_train,
+            SortedShuffledScheme(cifar10_train.num_examples, batch_size,
+                block_size=block_size),
+            functools.partial(padded_crop_flip, pad=4, levels=levels),
+            workers=workers)
 
     test_batch_size = 128
     cifar10_test = CIFAR10(("test",))
-    cifar10_test_stream = NormalizeBatchLevels(DataStream.default_stream(
+    cifar10_test_stream = normalized_levels(DataStream.default_stream(
         cifar10_test,
         iteration_scheme=ShuffledScheme(
             cifar10_test.num_examples, test_batch_size)),
-        which_sources=('features',))
+        levels=levels)
 
     momentum = Momentum(0.01, 0.9)
 
@@ -275,7 +307,8 @@ def main(save_to, num_epochs,
                           'test_error_rate',
                           ]],
                       after_epoch=True),
-                  EpochCheckpoint(save_to, use_cpickle=True, after_epoch=True),
+                  EpochCheckpoint(save_to, use_cpickle=True, after_epoch=True,
+                      device_datasets=device_datasets),
                   ProgressBar(),
                   Printing()]
 
@@ -290,6 +323,9 @@ def main(save_to, num_epochs,
     if resume:
         extensions.append(Load(exp_name, True, True))
 
+    if workers and not on_device:
+        extensions.insert(1, DataWaitFraction())
+
     model = Model(train_cost)
 
     main_loop = MainLoop(
@@ -337,6 +373,20 @@ if __name__ == "__main__":
                         help="Size of limited training set.")
     parser.add_argument('--resume', dest='resume', action='store_true')
     parser.add_argument('--no-resume', dest='resume', action='store_false')
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Processes augmenting the training data, "
+                             "default 0 to augment in the training "
+                             "process.")
+    parser.add_argument('--levels', dest='levels_file', default=None,
+                        help="File caching the channel statistics of the "
+                             "training set, to normalize by instead of by "
+                             "batch.")
+    parser.add_argument('--on-device', action='store_true',
+                        help="Keep the training set on the device and "
+                             "augment it in the training graph.")
+    parser.add_argument('--block-size', type=int, default=None,
+                        help="Read the shuffled training set in contiguous "
+                             "blocks of this many examples.")
     parser.set_defaults(resume=False)
     args = parser.parse_args()
     main(**vars(args))
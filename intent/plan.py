@@ -0,0 +1,216 @@
+"""Ablation planner.
+
+Searches for a small set of units whose ablation most changes one cell
+of the confusion matrix, e.g., how often a 2 is read as a 7:
+
+```
+python plan.py mnist.tar --cell 2 7 --beam-width 4 --budget 300
+```
+
+Candidate units are ranked by their attribution histograms, and ablation
+sets are grown by beam search (a beam width of 1 is greedy search).  Each
+round of candidate sets is evaluated on a pool of forked worker processes
+that share the cached activations of the target layer.
+"""
+import logging
+import pickle
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict
+from multiprocessing import get_context
+
+from theano import tensor
+
+from blocks.bricks.conv import Convolutional
+from blocks.bricks import Linear
+from blocks.filter import VariableFilter
+from blocks.filter import get_brick
+from blocks.graph import ComputationGraph
+from blocks.model import Model
+from blocks.roles import OUTPUT
+from blocks.serialization import load_parameters
+from fuel.datasets import MNIST
+from fuel.schemes import SequentialScheme
+from fuel.streams import DataStream
+from intent.ablation import AblationSolver
+from intent.ablation import ablate_inputs
+from intent.ablation import create_downstream_function
+from intent.ablation import stacked_confusion
+from intent.actcache import cache_activations
+from intent.actcache import cache_prefix
+from intent.actcache import predict_downstream
+from intent.actcache import sample_rows
+from intent.lenet import create_lenet_5
+import numpy
+
+# Read-only state shared with forked workers.  It is filled in before the
+# pool is created, so compiled functions and mmapped caches are inherited
+# by each worker instead of being pickled.
+_shared = {}
+
+def _cell_counts(target_sets):
+    """Counts cases in the target confusion cell for each ablation set."""
+    weights = _shared['weights']
+    variants = numpy.stack([
+        ablate_inputs(list(targets), _shared['sample'], weights,
+            compensate=_shared['compensate'], solver=_shared['solver'])
+        if len(targets) else weights
+        for targets in target_sets])
+    predicted = predict_downstream(_shared['downstream'],
+            _shared['activations'], variants,
+            batch_size=_shared['batch_size'])
+    confusion = stacked_confusion(
+            _shared['targets'], predicted, _shared['num_labels'])
+    row, col = _shared['cell']
+    return confusion[:, row, col]
+
+def rank_candidates(hist, cell):
+    """Orders units by how oppositely they are attributed to the two
+    classes of the confusion cell, most opposed first."""
+    row, col = cell
+    return numpy.argsort(hist[row] * hist[col], kind='mergesort')
+
+class AblationPlanner:
+    def __init__(self, workers=None, chunk_size=8):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.base_count = int(_cell_counts([()])[0])
+
+    def evaluate(self, pool, target_sets, deadline):
+        """Returns a list of (change, set), stopping early at the deadline."""
+        chunks = [target_sets[i:i + self.chunk_size]
+                for i in range(0, len(target_sets), self.chunk_size)]
+        results = []
+        for chunk, counts in zip(chunks, pool.imap(_cell_counts, chunks)):
+            results.extend((int(count) - self.base_count, targets)
+                    for count, targets in zip(counts, chunk))
+            if time.time() > deadline:
+                break
+        return results
+
+    def search(self, candidates, beam_width=1, max_units=10, budget=None,
+            goal=None):
+        """Beam search over ablation sets drawn from candidates.
+
+        Scores a set by the absolute change it makes to the target cell.
+        Returns the best set found, preferring smaller sets on ties, and
+        stops when the goal change is reached, the sets reach max_units,
+        or the time budget in seconds runs out.
+        """
+        deadline = time.time() + budget if budget else float('inf')
+        beam = [()]
+        best = (0, ())
+        with get_context('fork').Pool(self.workers) as pool:
+            for size in range(1, max_units + 1):
+                expanded = sorted(set(tuple(sorted(targets + (unit,)))
+                        for targets in beam for unit in candidates
+                        if unit not in targets))
+                if not expanded:
+                    break
+                results = self.evaluate(pool, expanded, deadline)
+                results.sort(key=lambda r: -abs(r[0]))
+                beam = [targets for _, targets in results[:beam_width]]
+                if results and abs(results[0][0]) > abs(best[0]):
+                    best = results[0]
+                logging.info("Size {}: {} sets, best change {} with {}".format(
+                    size, len(results), best[0], list(best[1])))
+                if goal is not None and abs(best[0]) >= goal:
+                    break
+                if time.time() > deadline:
+                    logging.info("Time budget exhausted")
+                    break
+        return best
+
+def main(save_to, hist_file, cell, candidates, beam_width, max_units,
+        budget, goal, compensate, workers):
+    batch_size = 500
+    output_size = 10
+    convnet = create_lenet_5()
+
+    x = tensor.tensor4('features')
+    probs = convnet.apply(x)
+    cg = ComputationGraph([probs])
+
+    def full_brick_name(brick):
+        return '/'.join([''] + [b.name for b in brick.get_unique_path()])
+
+    # Find layer outputs to probe
+    outs = OrderedDict((full_brick_name(get_brick(out)), out)
+            for out in VariableFilter(
+                roles=[OUTPUT], bricks=[Convolutional, Linear])(
+                    cg.variables))
+
+    model = Model([probs])
+    params = load_parameters(open(save_to, 'rb'))
+    model.set_parameter_values(params)
+
+    # TODO: allow target layer to be parameterized
+    target_layer = '/lenet/mlp/linear_0'
+    next_layer_param = '/lenet/mlp/linear_1.W'
+    param = model.get_parameter_dict()[next_layer_param]
+
+    mnist_test = MNIST(("test",))
+    mnist_test_stream = DataStream.default_stream(
+        mnist_test,
+        iteration_scheme=SequentialScheme(
+            mnist_test.num_examples, batch_size))
+    cache = cache_activations(
+            cache_prefix(save_to, target_layer),
+            outs[target_layer], mnist_test_stream, newer_than=save_to)
+    sample = sample_rows(cache['activations'], 2000)
+
+    _shared.update(
+        weights=param.get_value(),
+        sample=sample,
+        solver=AblationSolver(sample) if compensate else None,
+        compensate=compensate,
+        downstream=create_downstream_function(
+            probs, outs[target_layer], param),
+        activations=cache['activations'],
+        targets=cache['targets'].flatten(),
+        num_labels=output_size,
+        batch_size=batch_size,
+        cell=tuple(cell))
+
+    # Rank candidate units by their attributions to the two classes
+    with open(hist_file, 'rb') as handle:
+        histograms = pickle.load(handle)
+    hist = histograms[(target_layer.split('/')[-1], 'b')]
+    ranked = rank_candidates(hist, cell)[:candidates].tolist()
+    logging.info("Candidates: {}".format(ranked))
+
+    planner = AblationPlanner(workers=workers)
+    change, targets = planner.search(ranked, beam_width=beam_width,
+            max_units=max_units, budget=budget, goal=goal)
+    print('cell', tuple(cell), 'base count', planner.base_count)
+    print('ablating', len(targets), ':', list(targets))
+    print('change', change)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = ArgumentParser("Ablation set search for the MNIST dataset.")
+    parser.add_argument("save_to", default="mnist.tar", nargs="?",
+                        help="Destination to save the state of the training "
+                             "process.")
+    parser.add_argument("--hist-file", default="histograms.pkl",
+                        help="Histograms for reading out neuron intent")
+    parser.add_argument("--cell", type=int, nargs=2, default=[2, 7],
+                        help="Correct and predicted label of the confusion "
+                             "cell to change.")
+    parser.add_argument("--candidates", type=int, default=20,
+                        help="Number of top-ranked units to search over.")
+    parser.add_argument("--beam-width", type=int, default=1,
+                        help="Sets kept per round; 1 is greedy search.")
+    parser.add_argument("--max-units", type=int, default=10,
+                        help="Largest ablation set to consider.")
+    parser.add_argument("--budget", type=float, default=None,
+                        help="Time budget for the search in seconds.")
+    parser.add_argument("--goal", type=int, default=None,
+                        help="Stop at the first set changing the cell by "
+                             "at least this many cases.")
+    parser.add_argument("--compensate", action="store_true",
+                        help="Compensate ablated units by least squares.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes, default one per cpu.")
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,246 @@
+"""Multi-process prefetching for the training data streams.
+
+A PrefetchingStream runs a transformer chain, such as the padded crop
+and flip of the CIFAR runners, in worker processes so that augmentation
+overlaps with the optimizer steps:
+
+```
+stream = augmented_stream(cifar10_train,
+        ShuffledScheme(cifar10_train.num_examples, batch_size),
+        functools.partial(padded_crop_flip, pad=4), workers=4)
+```
+
+The requests of each epoch are dealt round robin to the workers, and
+batches are read back in the same order, so the examples of every batch
+match the serial stream.  Each worker draws its augmentation from its own
+RandomState seeded by seed + worker number, so runs are reproducible for
+a fixed number of workers.  Batches come back through shared-memory
+buffers, a few per worker, which bounds how far the workers run ahead.
+"""
+from multiprocessing import get_context
+from queue import Empty
+import time
+import traceback
+
+from blocks.extensions import SimpleExtension
+from fuel import config
+from fuel.schemes import BatchScheme
+from fuel.streams import AbstractDataStream
+from fuel.streams import DataStream
+from fuel.iterator import DataIterator
+import numpy
+
+class _RequestScheme(BatchScheme):
+    """Replays a fixed list of batch requests."""
+    def __init__(self, requests):
+        self.requests = requests
+
+    def get_request_iterator(self):
+        return iter(self.requests)
+
+def _prefetch_worker(dataset, transform, seed, buffers, commands, free,
+        ready):
+    rng = numpy.random.RandomState(seed)
+    arrays = [[numpy.frombuffer(buffer, dtype=dtype)
+            for buffer, dtype in slot] for slot in buffers]
+    try:
+        while True:
+            requests = commands.get()
+            if requests is None:
+                return
+            stream = transform(DataStream.default_stream(dataset,
+                iteration_scheme=_RequestScheme(requests)), rng)
+            for batch in stream.get_epoch_iterator():
+                slot = free.get()
+                shapes = []
+                for flat, data in zip(arrays[slot], batch):
+                    data = numpy.asarray(data)
+                    flat[:data.size] = data.ravel()
+                    shapes.append(data.shape)
+                ready.put((slot, shapes))
+    except Exception:
+        ready.put((None, traceback.format_exc()))
+
+class PrefetchingStream(AbstractDataStream):
+    """Runs transform(DataStream.default_stream(dataset, ...), rng) for
+    the requests of iteration_scheme in worker processes.
+
+    transform must be picklable, e.g., a module-level function or a
+    functools.partial of one, so that the stream can be checkpointed.
+    The workers are started on first use and again after unpickling.
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker processes.
+    queue_size : int
+        Number of batch buffers per worker.
+    """
+    # Seconds between checks that a worker is still alive
+    poll_interval = 1.0
+
+    def __init__(self, dataset, iteration_scheme, transform, workers=4,
+            queue_size=4, seed=config.default_seed, **kwargs):
+        self.dataset = dataset
+        self.transform = transform
+        self.workers = workers
+        self.queue_size = queue_size
+        self.seed = seed
+        self.wait_time = 0.0
+        self.requests = []
+        self.next_batch = 0
+        # Build one full batch here to learn the sources and batch sizes
+        probe = transform(DataStream.default_stream(dataset,
+            iteration_scheme=_RequestScheme(
+                [list(range(iteration_scheme.batch_size))])),
+            numpy.random.RandomState(seed))
+        self.sources = probe.sources
+        kwargs.setdefault('axis_labels', probe.axis_labels)
+        batch = [numpy.asarray(data)
+                for data in next(probe.get_epoch_iterator())]
+        self.layout = [(data.dtype, data.size) for data in batch]
+        self.processes = None
+        super(PrefetchingStream, self).__init__(
+                iteration_scheme=iteration_scheme, **kwargs)
+
+    def start(self):
+        context = get_context('fork')
+        self.buffers = [[[(context.RawArray('b', dtype.itemsize * size),
+            dtype) for dtype, size in self.layout]
+            for slot in range(self.queue_size)]
+            for worker in range(self.workers)]
+        self.arrays = [[[numpy.frombuffer(buffer, dtype=dtype)
+            for buffer, dtype in slot] for slot in worker]
+            for worker in self.buffers]
+        self.commands = [context.Queue() for _ in range(self.workers)]
+        self.free = [context.Queue() for _ in range(self.workers)]
+        self.ready = [context.Queue() for _ in range(self.workers)]
+        self.processes = []
+        for worker in range(self.workers):
+            for slot in range(self.queue_size):
+                self.free[worker].put(slot)
+            process = context.Process(target=_prefetch_worker, args=(
+                self.dataset, self.transform, self.seed + worker,
+                self.buffers[worker], self.commands[worker],
+                self.free[worker], self.ready[worker]))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        # Resume an epoch that was in progress when the stream was pickled
+        self.dispatch(self.next_batch)
+
+    def dispatch(self, start):
+        """Deals the requests from start on round robin to the workers."""
+        self.first_batch = start
+        for worker in range(self.workers):
+            self.commands[worker].put(
+                    self.requests[start + worker::self.workers])
+
+    def get_epoch_iterator(self, as_dict=False):
+        if self.processes is None:
+            self.start()
+        # Drain what the workers made for an epoch that was cut short
+        while self.next_batch < len(self.requests):
+            self.get_data(self.next_batch)
+        self.requests = list(self.iteration_scheme.get_request_iterator())
+        self.next_batch = 0
+        self.dispatch(0)
+        return DataIterator(self, iter(range(len(self.requests))),
+                as_dict=as_dict)
+
+    def get_data(self, request=None):
+        """Returns batch number request of the current epoch."""
+        if request != self.next_batch:
+            raise ValueError("batches must be read in order")
+        if self.processes is None:
+            self.start()
+        worker = (request - self.first_batch) % self.workers
+        start = time.time()
+        slot, shapes = self.wait_ready(worker)
+        self.wait_time += time.time() - start
+        batch = tuple(
+                flat[:numpy.prod(shape, dtype=int)].reshape(shape).copy()
+                for flat, shape in zip(self.arrays[worker][slot], shapes))
+        self.free[worker].put(slot)
+        self.next_batch += 1
+        return batch
+
+    def wait_ready(self, worker):
+        """Waits for the next batch of a worker, raising its error if it
+        failed, or if it exited without sending a batch."""
+        while True:
+            try:
+                slot, shapes = self.ready[worker].get(
+                        timeout=self.poll_interval)
+                break
+            except Empty:
+                process = self.processes[worker]
+                if process.is_alive():
+                    continue
+            # A worker that died may still have sent its last message
+            try:
+                slot, shapes = self.ready[worker].get(timeout=0.1)
+                break
+            except Empty:
+                raise RuntimeError("prefetch worker {} exited with code "
+                        "{}".format(worker, process.exitcode))
+        if slot is None:
+            raise RuntimeError("prefetch worker {} failed:\n{}".format(
+                worker, shapes))
+        return slot, shapes
+
+    def reset(self):
+        self.close()
+        self.requests = []
+        self.next_batch = 0
+
+    def next_epoch(self):
+        pass
+
+    def close(self):
+        if self.processes is None:
+            return
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        self.processes = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['processes', 'buffers', 'arrays', 'commands', 'free',
+                'ready']:
+            state.pop(key, None)
+        state['processes'] = None
+        return state
+
+def augmented_stream(dataset, iteration_scheme, transform, workers=0,
+        seed=config.default_seed, **kwargs):
+    """The transformed training stream, prefetched by worker processes,
+    or built in this process when workers is 0."""
+    if workers:
+        return PrefetchingStream(dataset, iteration_scheme, transform,
+                workers=workers, seed=seed, **kwargs)
+    return transform(DataStream.default_stream(dataset,
+        iteration_scheme=iteration_scheme), numpy.random.RandomState(seed))
+
+class DataWaitFraction(SimpleExtension):
+    """Logs the fraction of wall time the training loop spent waiting
+    for a PrefetchingStream as data_wait_fraction.
+
+    The stream is looked up on the main loop, since resuming with Load
+    replaces it by the checkpointed one.
+    """
+    def __init__(self, **kwargs):
+        kwargs.setdefault("every_n_batches", 10)
+        super(DataWaitFraction, self).__init__(**kwargs)
+        self.last = None
+
+    def do(self, which_callback, *args):
+        now = time.time()
+        wait_time = getattr(self.main_loop.data_stream, 'wait_time', 0.0)
+        if self.last is not None:
+            last_time, last_wait = self.last
+            if now > last_time:
+                self.main_loop.log.current_row['data_wait_fraction'] = (
+                    (wait_time - last_wait) / (now - last_time))
+        self.last = (now, wait_time)
@@ -33,7 +33,6 @@ from blocks.utils import shared_floatx
 from blocks.utils import dict_subset
 from fuel.datasets import MNIST
 from fuel.schemes import SequentialScheme
-from fuel.schemes import ShuffledScheme
 from fuel.streams import DataStream
 from intent.lenet import LeNet
 from intent.maxact import MaximumActivationSearch
@@ -46,6 +45,12 @@ from theano import tensor
 from intent.ablation import ConfusionMatrix
 from intent.ablation import Sum
 from intent.ablation import ablate_inputs
+from intent.ablation import create_downstream_function
+from intent.ablation import stacked_confusion
+from intent.actcache import cache_activations
+from intent.actcache import cache_prefix
+from intent.actcache import predict_downstream
+from intent.actcache import sample_rows
 from collections import OrderedDict
 import theano
 import numpy
@@ -55,22 +60,6 @@ import pickle
 # For testing
 from blocks.roles import OUTPUT
 
-def extract_sample(activations, data_stream, n=2000):
-    cg = ComputationGraph(activations)
-    input_names = [v.name for v in cg.inputs]
-    fn = theano.function(cg.inputs, [activations])
-    result = None
-    for batch in data_stream.get_epoch_iterator(as_dict=True):
-        values = fn(**dict_subset(batch, input_names))
-        if result is None:
-            result = values[0]
-        else:
-            result = numpy.concatenate((result, values[0]))
-        if result.shape[0] >= n:
-            result = result[(slice(0, n), ) +
-                    (slice(None),) * (len(result.shape) - 1)]
-            return result
-
 def main(save_to, hist_file):
     batch_size = 365
     feature_maps = [6, 16]
@@ -147,21 +136,20 @@ def main(save_to, hist_file):
         histograms = pickle.load(handle)
 
     # Corpora
-    mnist_train = MNIST(("train",))
-    mnist_train_stream = DataStream.default_stream(
-        mnist_train, iteration_scheme=ShuffledScheme(
-            mnist_train.num_examples, batch_size))
-
     mnist_test = MNIST(("test",))
-    mnist_test_stream = DataStream.default_stream(
-        mnist_test,
-        iteration_scheme=ShuffledScheme(
-            mnist_test.num_examples, batch_size))
 
-    # Probe the given layer
+    # Probe the given layer, caching its activations on the test set
     target_layer = '/lenet/mlp/linear_0'
     next_layer_param = '/lenet/mlp/linear_1.W'
-    sample = extract_sample(outs[target_layer], mnist_test_stream)
+    mnist_test_sequential_stream = DataStream.default_stream(
+        mnist_test,
+        iteration_scheme=SequentialScheme(
+            mnist_test.num_examples, batch_size))
+    cache = cache_activations(
+            cache_prefix(save_to, target_layer),
+            outs[target_layer], mnist_test_sequential_stream,
+            newer_than=save_to)
+    sample = sample_rows(cache['activations'], 2000)
     print('sample shape', sample.shape)
 
     # Figure neurons to ablate
@@ -181,9 +169,15 @@ def main(save_to, hist_file):
         compensate=False)
     param.set_value(new_weights)
 
-    # Evaluation pass
-    evaluator = DatasetEvaluator([error_rate, confusion])
-    print(evaluator.evaluate(mnist_test_stream))
+    # Evaluation pass, running only the layers above the target layer
+    downstream = create_downstream_function(probs, outs[target_layer])
+    predicted = predict_downstream(downstream, cache['activations'],
+            batch_size=batch_size)
+    labels = cache['targets'].flatten()
+    confusion = stacked_confusion(labels, predicted[None, :], output_size)[0]
+    print(OrderedDict([
+        ('error_rate', 1 - numpy.trace(confusion) / len(labels)),
+        ('confusion', confusion)]))
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -6,6 +6,7 @@ python run.py --num-epochs 20
 ```
 
 """
+import json
 import logging
 from argparse import ArgumentParser
 from http.server import BaseHTTPRequestHandler, HTTPServer
@@ -38,7 +39,16 @@ from fuel.streams import DataStream
 from intent.ablation import ConfusionMatrix
 from intent.ablation import ConfusionImage
 from intent.ablation import Sum
+from intent.ablation import AblationSolver
 from intent.ablation import ablate_inputs
+from intent.ablation import confusion_image_sums
+from intent.ablation import create_downstream_function
+from intent.ablation import stacked_confusion
+from intent.actcache import cache_activations
+from intent.actcache import cache_prefix
+from intent.actcache import predict_downstream
+from intent.actcache import sample_rows
+from intent.topk import cached_index
 from intent.lenet import create_lenet_5
 from intent.maxact import MaximumActivationSearch
 from intent.filmstrip import Filmstrip
@@ -54,22 +64,6 @@ import numbers
 # For testing
 from blocks.roles import OUTPUT
 
-def extract_sample(activations, data_stream, n=2000):
-    cg = ComputationGraph(activations)
-    input_names = [v.name for v in cg.inputs]
-    fn = theano.function(cg.inputs, [activations])
-    result = None
-    for batch in data_stream.get_epoch_iterator(as_dict=True):
-        values = fn(**dict_subset(batch, input_names))
-        if result is None:
-            result = values[0]
-        else:
-            result = numpy.concatenate((result, values[0]))
-        if result.shape[0] >= n:
-            result = result[(slice(0, n), ) +
-                    (slice(None),) * (len(result.shape) - 1)]
-            return result
-
 class AblationTester:
     def __init__(self, save_to):
         batch_size = 500
@@ -130,21 +124,46 @@ class AblationTester:
             iteration_scheme=SequentialScheme(
                 mnist_test.num_examples, batch_size))
 
-        self.model = model
-        self.mnist_test_stream = mnist_test_stream
-        self.evaluator = DatasetEvaluator(
-                [error_rate, confusion, confusion_image])
-        self.base_results = self.evaluator.evaluate(mnist_test_stream)
-
         # TODO: allow target layer to be parameterized
         self.target_layer = '/lenet/mlp/linear_0'
         self.next_layer_param = '/lenet/mlp/linear_1.W'
-        self.base_sample = extract_sample(
-                outs[self.target_layer], mnist_test_stream)
-        self.base_param_value = (
-            model.get_parameter_dict()[
-                self.next_layer_param].get_value().copy())
+        param = model.get_parameter_dict()[self.next_layer_param]
+
+        # Activations of the target layer over the test set are cached
+        # next to the model, so that an ablation only runs the layers above.
+        self.cache = cache_activations(
+                cache_prefix(save_to, self.target_layer),
+                outs[self.target_layer], mnist_test_stream,
+                sources=('targets', 'features'), newer_than=save_to)
+        self.targets = self.cache['targets'].flatten()
+        self.num_labels = output_size
+        self.batch_size = batch_size
+        self.model = model
+        self.base_sample = sample_rows(self.cache['activations'], 2000)
+        self.solver = AblationSolver(self.base_sample)
+        self.topk = cached_index(
+                cache_prefix(save_to, self.target_layer) + '.topk.npz',
+                self.cache['activations'], newer_than=save_to)
+        self.base_param_value = param.get_value().copy()
+        self.downstream = create_downstream_function(
+                probs, outs[self.target_layer])
+        self.stacked_downstream = create_downstream_function(
+                probs, outs[self.target_layer], param)
+        self.base_results = self.evaluate_predictions(predict_downstream(
+                self.downstream, self.cache['activations'],
+                batch_size=batch_size))
 
+    def evaluate_predictions(self, predicted, confusion_image=True):
+        confusion = stacked_confusion(
+                self.targets, predicted[None, :], self.num_labels)[0]
+        result = OrderedDict([
+            ('error_rate', 1 - numpy.trace(confusion) / len(self.targets)),
+            ('confusion', confusion)])
+        if confusion_image:
+            result['confusion_image'] = confusion_image_sums(
+                    self.targets, predicted, self.cache['features'],
+                    self.num_labels)
+        return result
 
     def probe_ablation(self, targets, differential=True, compensate=False):
         # Probe the given layer
@@ -160,18 +179,50 @@ class AblationTester:
                 targets,
                 self.base_sample,
                 param.get_value(),
-                compensate=compensate)
+                compensate=compensate,
+                solver=self.solver)
             param.set_value(new_weights)
-        # Evaluation pass
-        result = self.evaluator.evaluate(self.mnist_test_stream)
+        # Evaluation pass, over the cached activations only
+        predicted = predict_downstream(self.downstream,
+                self.cache['activations'], batch_size=self.batch_size)
         # Reset params back to baseline value
         param.set_value(self.base_param_value)
+        result = self.evaluate_predictions(predicted)
         # Result contains error_rate, confusion, and confusion_image
         if differential:
             for key in result:
                 result[key] -= self.base_results[key]
         return result
 
+    def probe_ablations(self, target_sets, differential=True, compensate=False):
+        """Evaluates many ablation sets in one pass over the test set.
+
+        Instead of re-running the whole network per set, this runs only
+        the layers above the target layer, over its cached activations,
+        with one stacked weight variant per ablation set.  Returns a list
+        with one dict of error_rate and confusion per set.
+        """
+        if not len(target_sets):
+            return []
+        variants = numpy.stack([
+            ablate_inputs(targets, self.base_sample,
+                self.base_param_value, compensate=compensate,
+                solver=self.solver)
+            if len(targets) else self.base_param_value
+            for targets in target_sets])
+        predictions = predict_downstream(self.stacked_downstream,
+                self.cache['activations'], variants,
+                batch_size=self.batch_size)
+        results = []
+        for predicted in predictions:
+            result = self.evaluate_predictions(
+                    predicted, confusion_image=False)
+            if differential:
+                for key in result:
+                    result[key] = result[key] - self.base_results[key]
+            results.append(result)
+        return results
+
 class QueryHTTPServer(HTTPServer):
     def __init__(self, tester, *args, **kw):
         super(QueryHTTPServer, self).__init__(*args, **kw)
@@ -200,6 +251,12 @@ class QueryRequestHandler(BaseHTTPRequestHandler):
         if url.path == '/ablate':
             self.ablate(url, fields)
             return
+        if url.path == '/ablations':
+            self.ablations(url, fields)
+            return
+        if url.path == '/top':
+            self.top(url, fields)
+            return
 
         # Send response status code
         self.send_response(200)
@@ -236,6 +293,42 @@ class QueryRequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(filmstrip.save_bytes())
  
+    def ablations(self, url, fields):
+        if 'units' not in fields:
+            self.send_error(400, 'No units to ablate')
+            return
+        target_sets = [[int(u) for u in units.split(',') if u]
+                for units in fields['units']]
+        compensate = False
+        if 'compensate' in fields:
+            compensate = True
+        results = self.server.tester.probe_ablations(
+                target_sets, compensate=compensate)
+        listing = [OrderedDict([
+                ('units', units),
+                ('error_rate', float(result['error_rate'])),
+                ('confusion', result['confusion'].tolist())])
+            for units, result in zip(target_sets, results)]
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+        self.wfile.write(bytes(json.dumps(listing), "utf8"))
+
+    def top(self, url, fields):
+        unit = int(fields.get('unit', ['0'])[0])
+        k = None
+        if 'k' in fields:
+            k = int(fields['k'][0])
+        values, ids, _ = self.server.tester.topk.top(unit, k)
+        listing = OrderedDict([
+            ('unit', unit),
+            ('ids', ids[ids >= 0].tolist()),
+            ('values', values[ids >= 0].tolist())])
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+        self.wfile.write(bytes(json.dumps(listing), "utf8"))
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     parser = ArgumentParser("Gradient descent vis for the MNIST dataset.")
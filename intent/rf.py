@@ -2,7 +2,20 @@ from blocks.bricks.conv import Convolutional
 from blocks.bricks.conv import Pooling
 from blocks.bricks.conv import ConvolutionalSequence
 from blocks.bricks.conv import Flattener
+from blocks.bricks import FeedforwardSequence
+from blocks.bricks import Linear
+from blocks.bricks import MLP
+from blocks.filter import get_brick
+from intent.allconv import GlobalAverageFlattener as AllConvAverageFlattener
+from intent.flatten import GlobalAverageFlattener
+from intent.noisy import NoisyConvolutional
+from intent.noisy import NoisyConvolutional2
+from intent.resnet import ResidualConvolutional
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+from scipy.ndimage.filters import correlate1d
 from scipy.ndimage.filters import gaussian_filter
+import functools
 import numpy
 
 def receptive_field(location, fieldmap):
@@ -16,14 +29,26 @@ def receptive_field(location, fieldmap):
         The (offset, size, step) tuple fieldmap representing the
         receptive field map for the layer being queried.
     """
-    return compose_fieldmap(rf, (location, (1, 1), (1, 1)))[:2]
+    return compose_fieldmap(fieldmap, (location, (1, 1), (1, 1)))[:2]
+
+def _convolution_fieldmap(filter_size, border_mode, step):
+    offset = edge_mode_offset(border_mode or 'valid', filter_size)
+    return (offset, tuple(filter_size), tuple(step or (1, 1)))
 
 def layer_fieldmap(brick):
-    if isinstance(brick, Convolutional):
-        size = brick.filter_size
-        offset = edge_mode_offset(brick.border_mode or 'valid', size)
-        step = brick.step or (1, 1)
-        return (offset, size, step)
+    if isinstance(brick, ResidualConvolutional):
+        # Two convolutions, the first strided; the shortcut's field is
+        # contained in theirs
+        return compose_fieldmap(
+            _convolution_fieldmap(brick.filter_size, brick.border_mode,
+                brick.step),
+            _convolution_fieldmap(brick.filter_size, brick.border_mode,
+                (1, 1)))
+    if isinstance(brick, (Convolutional, NoisyConvolutional,
+            NoisyConvolutional2)):
+        # The noisy convolutions add a 1x1 mask after the convolution
+        return _convolution_fieldmap(brick.filter_size, brick.border_mode,
+                brick.step)
     if isinstance(brick, Pooling):
         size = brick.pooling_size
         offset = edge_mode_offset(brick.padding or (0, 0), size)
@@ -31,7 +56,8 @@ def layer_fieldmap(brick):
         return (offset, size, step)
     if isinstance(brick, ConvolutionalSequence):
         return layerarray_fieldmap(brick.layers)
-    if isinstance(brick, Flattener):
+    if isinstance(brick, (Flattener, GlobalAverageFlattener,
+            AllConvAverageFlattener, Linear, MLP)):
         return ((0, 0), (float('inf'), float('inf')), (1, 1))
     return ((0, 0), (1, 1), (1, 1))
 
@@ -41,6 +67,61 @@ def layerarray_fieldmap(layerarray):
         fieldmap = compose_fieldmap(fieldmap, layer_fieldmap(layer))
     return fieldmap
 
+def full_brick_name(brick):
+    return '/'.join([''] + [b.name for b in brick.get_unique_path()])
+
+def _walk_fieldmaps(brick, fieldmap, table):
+    """Records the fieldmap of brick and of the bricks inside it, given
+    the fieldmap of its input, and returns the fieldmap of its output."""
+    if isinstance(brick, ConvolutionalSequence):
+        for layer in brick.layers:
+            fieldmap = _walk_fieldmaps(layer, fieldmap, table)
+    elif isinstance(brick, FeedforwardSequence):
+        for method in brick.application_methods:
+            fieldmap = _walk_fieldmaps(method.brick, fieldmap, table)
+    elif isinstance(brick, ResidualConvolutional):
+        inner = compose_fieldmap(fieldmap, _convolution_fieldmap(
+            brick.filter_size, brick.border_mode, brick.step))
+        table[full_brick_name(brick.c0)] = inner
+        table[full_brick_name(brick.c1)] = compose_fieldmap(inner,
+            _convolution_fieldmap(brick.filter_size, brick.border_mode,
+                (1, 1)))
+        fieldmap = compose_fieldmap(fieldmap, layer_fieldmap(brick))
+    else:
+        fieldmap = compose_fieldmap(fieldmap, layer_fieldmap(brick))
+    table[full_brick_name(brick)] = fieldmap
+    return fieldmap
+
+_model_fieldmaps = WeakKeyDictionary()
+
+def model_fieldmaps(model):
+    """Fieldmaps of the outputs of every brick in a model, by full name.
+
+    The table is computed once per model instance, since filter sizes,
+    strides and border modes are configured per instance.
+    """
+    if model not in _model_fieldmaps:
+        table = OrderedDict()
+        _walk_fieldmaps(model, ((0, 0), (1, 1), (1, 1)), table)
+        _model_fieldmaps[model] = table
+    return _model_fieldmaps[model]
+
+def output_fieldmap(model, output):
+    """Looks up the fieldmap of an output variable of a model's brick."""
+    return model_fieldmaps(model)[full_brick_name(get_brick(output))]
+
+def snapshot_window(fieldmap, map_shape):
+    """The (height, width) window of a map_shape activation map, centered
+    at a unit, that holds every unit whose receptive field overlaps the
+    field of that unit; None when the window is no smaller than the map.
+    """
+    offset, size, step = fieldmap
+    window = tuple(2 * int(numpy.ceil(s / t)) - 1
+            for s, t in zip(size, step))
+    if any(w >= m for w, m in zip(window, map_shape)):
+        return None
+    return window
+
 def is_iterable(x):
     return hasattr(x, '__iter__')
 
@@ -85,32 +166,43 @@ def compose_fieldmap(rf1, rf2):
             for step1c, step2c in zip(step1, step2))
     return (offset, size, step)
 
-def _cropped_slices(offset, size, limit):
-    corner = 0
-    if offset < 0:
-        size += offset
-        offset = 0
-    if limit - offset < size:
-        corner = limit - offset
-        size -= corner
-    return (slice(corner, corner + size), slice(offset, offset + size))
-
 def crop_field(image_data, fieldmap, location):
     """Crops image_data to the specified receptive field.
 
-    Together fieldmap and location specify a receptive field on the image,
+    Imagine the field as being placed on the image as specified,
     which may overlap the edge. This returns a crop to that shape, including
     any zero padding necessary to fill out the shape beyond the image edge.
     """
-    coloraxis = 0 if image_data.size <= 2 else 1
-    allcolors = () if not coloraxis else (slice(None),) * coloraxis
-    colordepth = () if not coloraxis else (image_data.size[0], )
-    offset, size = receptive_field(fieldmap, location)
-    result = numpy.zeros(colordepth + size)
-    (xto, xfrom), (yto, yfrom) = (_cropped_slices(
-        o, s, l) for o, s, l in zip(offset, size, image_data.size[coloraxis:]))
-    result[allcolors + (xto, yto)] = image_data[allcolors + (xfrom, yfrom)]
-    return result
+    return crop_fields(image_data[numpy.newaxis], fieldmap,
+            numpy.array([location]))[0]
+
+def crop_fields(image_stack, fieldmap, locations):
+    """Batched crop_field for a (cases, [colors,] height, width) stack.
+
+    locations is a (cases, 2) array with the activation location for each
+    image.  Every crop has the size of the field, so the crops are
+    gathered by one fancy index with the coordinates clipped to the image,
+    and the parts of the field beyond the image edge are then zeroed.
+    """
+    image_stack = numpy.asarray(image_stack)
+    offset, size, step = fieldmap
+    corners = numpy.asarray(locations) * step + offset
+    height, width = image_stack.shape[-2:]
+    rows = corners[:, 0, None] + numpy.arange(size[0])
+    cols = corners[:, 1, None] + numpy.arange(size[1])
+    inside = (((rows >= 0) & (rows < height))[:, :, None] &
+              ((cols >= 0) & (cols < width))[:, None, :])
+    cases = numpy.arange(len(image_stack))[:, None, None]
+    rows = rows.clip(0, height - 1)[:, :, None]
+    cols = cols.clip(0, width - 1)[:, None, :]
+    if image_stack.ndim == 4:
+        # Advanced indices around the color slice put colors last
+        crops = numpy.moveaxis(image_stack[cases, :, rows, cols], -1, 1)
+        inside = inside[:, numpy.newaxis]
+    else:
+        crops = image_stack[cases, rows, cols]
+    crops[~numpy.broadcast_to(inside, crops.shape)] = 0
+    return crops
 
 def _gaussian_1d(size, sigma):
     n = numpy.arange(0, size) - (size - 1.0) / 2.0
@@ -155,3 +247,33 @@ def make_mask(image_shape, fieldmap, activation_data,
         activations, sigma=tuple(s * sigma for s in shape), mode='constant')
     maximum = blurred.flatten().max()
     return 1 - (1 - alpha) * (blurred < maximum * 0.9)
+
+@functools.lru_cache(maxsize=None)
+def _gaussian_kernel(sigma, truncate=4.0):
+    """The normalized 1d kernel that gaussian_filter uses for sigma."""
+    radius = int(truncate * float(sigma) + 0.5)
+    x = numpy.arange(-radius, radius + 1)
+    kernel = numpy.exp(-0.5 / (sigma * sigma) * x ** 2)
+    return kernel / kernel.sum()
+
+def make_masks(image_shape, fieldmap, activation_stack,
+                sigma=0.2, threshold=0.9, alpha=0.1):
+    """Batched make_mask for a (..., height, width) stack of activations.
+
+    All maps are placed into one stacked array and blurred together by a
+    separable convolution along the two spatial axes, using a cached
+    gaussian kernel for each fieldmap size.  Returns masks shaped
+    activation_stack.shape[:-2] + image_shape.
+    """
+    offset, shape, step = fieldmap
+    activation_stack = numpy.asarray(activation_stack)
+    lead = activation_stack.shape[:-2]
+    activations = numpy.zeros(lead + tuple(image_shape))
+    activations[(Ellipsis,) + _centered_slice(
+        fieldmap, activation_stack.shape[-2:])] = activation_stack
+    blurred = activations
+    for axis, size in zip((-2, -1), shape):
+        blurred = correlate1d(blurred, _gaussian_kernel(size * sigma),
+                axis=axis, mode='constant')
+    maximum = blurred.max(axis=(-2, -1), keepdims=True)
+    return 1 - (1 - alpha) * (blurred < maximum * threshold)
@@ -37,6 +37,8 @@ from intent.attrib import print_attributions
 from intent.attrib import save_attributions
 from intent.ablation import ConfusionMatrix
 from intent.ablation import Sum
+from intent.memdata import corpus
+from intent.noisy import SortedShuffledScheme
 import json
 from json import JSONEncoder, dumps
 import numpy
@@ -45,7 +47,7 @@ import numpy
 
 def main(save_to, num_epochs,
          regularization=0.0003, subset=None, num_batches=None,
-         histogram=None, resume=False):
+         histogram=None, resume=False, memmap=None):
     batch_size = 500
     output_size = 10
     convnet = create_lenet_5()
@@ -75,16 +77,17 @@ def main(save_to, num_epochs,
     cost = cost + regularization * l2_norm
     cost.name = 'cost_with_regularization'
 
+    Corpus = corpus(MNIST, memmap)
     if subset:
         start = 30000 - subset // 2
-        mnist_train = MNIST(("train",), subset=slice(start, start+subset))
+        mnist_train = Corpus(("train",), subset=slice(start, start+subset))
     else:
-        mnist_train = MNIST(("train",))
+        mnist_train = Corpus(("train",))
     mnist_train_stream = DataStream.default_stream(
-        mnist_train, iteration_scheme=ShuffledScheme(
+        mnist_train, iteration_scheme=SortedShuffledScheme(
             mnist_train.num_examples, batch_size))
 
-    mnist_test = MNIST(("test",))
+    mnist_test = Corpus(("test",))
     mnist_test_stream = DataStream.default_stream(
         mnist_test,
         iteration_scheme=ShuffledScheme(
@@ -167,6 +170,9 @@ if __name__ == "__main__":
                         help="Size of limited training set.")
     parser.add_argument('--resume', dest='resume', action='store_true')
     parser.add_argument('--no-resume', dest='resume', action='store_false')
+    parser.add_argument('--memmap', default=None,
+                        help="Directory of arrays written by memdata.py to "
+                             "read instead of the Fuel dataset.")
     parser.set_defaults(resume=False)
     args = parser.parse_args()
     main(**vars(args))
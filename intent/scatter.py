@@ -5,11 +5,25 @@ import numpy
 import pkg_resources
 import io
 
+class _CorpusImages:
+    """Indexes features of a fuel dataset one example at a time."""
+    def __init__(self, corpus):
+        self.corpus = corpus
+
+    def __getitem__(self, index):
+        return self.corpus.get_data(request=index)[0]
+
+def bucket_membership(values, numbuckets):
+    """Assigns values to numbuckets equal-width buckets in one digitize."""
+    edges = numpy.linspace(values.min(), values.max(), numbuckets + 1)
+    return numpy.digitize(values, edges[1:-1])
+
 class Scatter:
     def __init__(self, shape=None, unit_shape=None,
-            background='white'):
+            background='white', margin=None):
         self.shape = shape or (512, 512)
-        self.margin = tuple(d // 2 for d in (unit_shape or (28, 28)))
+        self.unit_shape = unit_shape or (28, 28)
+        self.margin = margin or tuple(d // 2 for d in self.unit_shape)
         self.background = background
         self.im = Image.new('RGB',
                 tuple(reversed(self.shape)), self.background)
@@ -44,6 +58,52 @@ class Scatter:
             # self.draw.bitmap([corner], one_image)
             self.im.paste(one_image, corner, mask=one_image)
 
+    def corners_from_locations(self, locations, image_size):
+        """Vectorized corner_from_location returning (N, 2) (row, col)."""
+        shape = numpy.asarray(self.shape)
+        margin = numpy.asarray(self.margin)
+        return (margin + (shape - margin * 2) * locations[:, :2]
+                - numpy.asarray(image_size) / 2).astype(numpy.int64)
+
+    def set_sprites(self, locations, sprites, fill=None):
+        """Composites a stack of (N, H, W, 4) sprites in one array pass.
+
+        All sprites share a single fill color, so stacking order does not
+        affect the result: each pixel keeps the product of the
+        transparencies of the sprites covering it.
+        """
+        if fill is None:
+            fill = (0, 0, 0)
+        if not len(sprites):
+            return
+        height, width = sprites.shape[1:3]
+        corners = self.corners_from_locations(locations, (height, width))
+        rows = (corners[:, 0, None, None] +
+                numpy.arange(height)[None, :, None])
+        cols = (corners[:, 1, None, None] +
+                numpy.arange(width)[None, None, :])
+        rows, cols = numpy.broadcast_arrays(rows, cols)
+        inside = ((rows >= 0) & (rows < self.shape[0]) &
+                  (cols >= 0) & (cols < self.shape[1]))
+        if not inside.any():
+            return
+        rows, cols = rows[inside], cols[inside]
+        alpha = sprites[:, :, :, 3][inside] / 255.0
+        # Only the bounding box of the sprites is read back and rewritten
+        top, left = rows.min(), cols.min()
+        bottom, right = rows.max() + 1, cols.max() + 1
+        box = (int(left), int(top), int(right), int(bottom))
+        canvas = numpy.array(self.im.crop(box))
+        flat = (rows - top) * (right - left) + (cols - left)
+        touched, inverse = numpy.unique(flat, return_inverse=True)
+        transmit = numpy.ones(len(touched))
+        numpy.multiply.at(transmit, inverse.ravel(), 1 - alpha)
+        pixels = canvas.reshape((-1, canvas.shape[-1]))
+        pixels[touched] = (pixels[touched] * transmit[:, None] +
+                numpy.asarray(fill, dtype=numpy.float64)[None, :] *
+                (1 - transmit[:, None])).round().astype(numpy.uint8)
+        self.im.paste(Image.fromarray(canvas), box[:2])
+
     def set_text(self, location, text, size=None, fill='black'):
         if size is None:
             size = int(self.image_shape[0] / 2)
@@ -59,48 +119,101 @@ class Scatter:
             y += h
 
     def draw_line(self, locations, fill='black', width=2):
-        x0, y0 = self.corner_from_location(locations[0])
-        for loc in locations[1:]:
-            x1, y1 = self.corner_from_location(loc)
-            self.draw.line((x0, y0, x1, y1), fill=fill, width=width)
-            x0, y0 = x1, y1
+        if len(locations) < 2:
+            return
+        corners = self.corners_from_locations(numpy.asarray(locations), (0, 0))
+        self.draw.line([(x, y) for y, x in corners], fill=fill, width=width)
 
-    def plot_scatter(self, corpus=None, locations=None):
+    def visible_points(self, points):
+        """Marks points whose image would overlap the canvas."""
+        corners = self.corners_from_locations(points, self.unit_shape)
+        return ((corners > -numpy.asarray(self.unit_shape)) &
+                (corners < numpy.asarray(self.shape))).all(axis=1)
+
+    def representatives(self, points, ordering, cell_size):
+        """Marks the first point in ordering within each occupied cell.
+
+        Cells are cell_size pixel squares of the canvas, so at low zoom
+        a dense cluster is drawn as a single image.
+        """
+        chosen = numpy.zeros(len(points), dtype=bool)
+        if not len(ordering):
+            return chosen
+        cells = self.corners_from_locations(points[ordering], (0, 0)
+                ) // cell_size
+        cells -= cells.min(axis=0)
+        keys = cells[:, 0] * (cells[:, 1].max() + 1) + cells[:, 1]
+        _, first = numpy.unique(keys, return_index=True)
+        chosen[ordering[first]] = True
+        return chosen
+
+    def paint_points(self, points, indexes, images=None, sprites=None,
+            fill=None):
+        if sprites is not None:
+            self.set_sprites(points[indexes], sprites[indexes], fill=fill)
+        else:
+            for o in indexes:
+                self.set_image(points[o], images[o][0], fill=fill)
+
+    def plot_scatter(self, corpus=None, locations=None, images=None,
+            sprites=None, viewport=None, cell_size=None):
+        """Plots example images at the locations given by their activations.
+
+        The first two columns of locations position each example.  A third
+        column orders the examples along a connecting line, and a fourth
+        column splits them into 100 colored buckets.
+
+        viewport is an optional (top, left, bottom, right) rectangle in
+        normalized [0, 1] coordinates, used to render one zoomed tile of
+        the whole plot.  When cell_size is given, the canvas is binned into
+        cell_size pixel squares and only one image per occupied cell is
+        drawn; lines still connect every point.
+        """
+        if images is None and sprites is None:
+            images = _CorpusImages(corpus)
         offset = locations[: ,:2].min(axis=0)
         scale = locations[:, :2].max(axis=0) - offset
         points = (locations[:, :2] - offset) / scale
+        if viewport is not None:
+            corner = numpy.asarray(viewport[:2], dtype=numpy.float64)
+            extent = numpy.asarray(viewport[2:], dtype=numpy.float64) - corner
+            points = (points - corner) / extent
         if locations.shape[1] > 2:
             ordering = locations[:, 2].argsort()
-            if locations.shape[1] == 4:
-                numbuckets = 100
-                minbucket = locations[:, 3].min()
-                bucketscale = ((locations[:, 3].max() - minbucket) / numbuckets
-                        ) * (1 + 1e-9)
-            else:
-                numbuckets = 1
-                minbucket = bucketscale = None
-            longest = None
-            for x in range(numbuckets):
-                if numbuckets is 1:
-                    bucket = ordering
-                else:
-                    bucket = [o for o in ordering
-                        if x <= (locations[o, 3] - minbucket) / bucketscale < x + 1]
-                if len(bucket):
-                    color = (int(255 * x / numbuckets), 0,
-                            int(255 * (1 - x / numbuckets)))
-                    self.draw_line([points[o] for o in bucket], fill=color + (20,))
-                    for o in bucket:
-                        self.set_image(points[o], corpus.get_data(request=o)[0][0],
-                                fill=color)
-                    if not longest or len(longest) < len(bucket):
-                        longest = bucket
-            if longest:
-                self.draw_line([points[o] for o in longest],
-                    fill=(255, 255, 0, 128))
         else:
-            for i in range(len(points)):
-                self.set_image(points[i], corpus.get_data(request=i)[0][0])
+            ordering = numpy.arange(len(points))
+        shown = self.visible_points(points)
+        if cell_size:
+            shown &= self.representatives(
+                    points, ordering[shown[ordering]], cell_size)
+        if locations.shape[1] == 2:
+            self.paint_points(points, ordering[shown[ordering]],
+                    images, sprites)
+            return
+        if locations.shape[1] == 4:
+            numbuckets = 100
+            membership = bucket_membership(locations[:, 3], numbuckets)
+        else:
+            numbuckets = 1
+            membership = numpy.zeros(len(points), dtype=numpy.int64)
+        # Group the ordering by bucket, keeping the order within each bucket
+        membership = membership[ordering]
+        grouped = ordering[numpy.argsort(membership, kind='mergesort')]
+        bounds = numpy.searchsorted(numpy.sort(membership),
+                numpy.arange(numbuckets + 1))
+        longest = None
+        for x in range(numbuckets):
+            bucket = grouped[bounds[x]:bounds[x + 1]]
+            if len(bucket):
+                color = (int(255 * x / numbuckets), 0,
+                        int(255 * (1 - x / numbuckets)))
+                self.draw_line(points[bucket], fill=color + (20,))
+                self.paint_points(points, bucket[shown[bucket]],
+                        images, sprites, fill=color)
+                if longest is None or len(longest) < len(bucket):
+                    longest = bucket
+        if longest is not None:
+            self.draw_line(points[longest], fill=(255, 255, 0, 128))
 
     def save(self, filename):
         dirname = os.path.dirname(filename)
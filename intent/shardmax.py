@@ -0,0 +1,180 @@
+"""Sharded maximum activation search.
+
+Splits the chosen splits of a dataset into contiguous shards, runs
+MaximumActivationSearch over each shard in a separate worker process,
+and merges the per-shard top-k results exactly into one index per layer:
+
+```
+python shardmax.py lenet mnist.tar --splits train test --workers 8
+```
+
+Examples are numbered across the splits in the order given, so with
+``--splits train test`` the test examples follow the training examples.
+The merged indexes are saved with intent.topk.save_indexes; an index of
+the test split alone can be read by ``view.py --index``.
+
+CIFAR inputs are normalized by the channel statistics of the training
+set, not by batch, so any number of shards finds the same top examples.
+"""
+import logging
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict
+from multiprocessing import get_context
+
+from theano import tensor
+
+from blocks.bricks.conv import Convolutional
+from blocks.bricks import Linear
+from blocks.filter import VariableFilter
+from blocks.filter import get_brick
+from blocks.graph import ComputationGraph
+from blocks.model import Model
+from blocks.roles import OUTPUT
+from blocks.serialization import load_parameters
+from fuel.schemes import SequentialScheme
+from fuel.streams import DataStream
+from intent.maxact import MaximumActivationSearch
+from intent.memdata import corpus
+from intent.sweep import MODELS
+from intent.topk import index_from_search
+from intent.topk import save_indexes
+from intent.transform import NormalizeLevels
+from intent.transform import cached_level_statistics
+from intent.transform import level_statistics
+import numpy
+
+# Compiled search shared with forked workers, filled in before the fork.
+# Each worker resets its own copy of the search state for every shard.
+_shared = {}
+
+def shard_ranges(num_examples, num_shards):
+    """Splits range(num_examples) into contiguous (start, stop) ranges."""
+    bounds = numpy.linspace(0, num_examples, num_shards + 1).astype(int)
+    return [(int(start), int(stop))
+            for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+def _search_shard(shard):
+    """Runs the search over one shard, returning its per-layer indexes."""
+    split, start, stop, offset = shard
+    algorithm = _shared['algorithm']
+    # Start from empty slots, so every activation can enter and unfilled
+    # slots are marked by id -1 rather than posing as example 0
+    for dims, quantity, index, snapshot in (
+            algorithm.maximum_activations.values()):
+        quantity.set_value(numpy.full_like(quantity.get_value(), -numpy.inf))
+        index.set_value(numpy.full_like(index.get_value(), -1))
+    # Numbering from the shard's start keeps example ids global
+    algorithm.streamindex.set_value(offset + start)
+    corpus = _shared['corpus']((split,), sources=('features',))
+    stream = DataStream.default_stream(corpus,
+            iteration_scheme=SequentialScheme(
+                list(range(start, stop)), _shared['batch_size']))
+    if _shared['levels'] is not None:
+        stream = NormalizeLevels(stream, *_shared['levels'],
+                which_sources=('features',))
+    for batch in stream.get_epoch_iterator(as_dict=True):
+        algorithm.process_batch(batch)
+    return OrderedDict((name, index_from_search(record))
+            for name, record in zip(_shared['names'],
+                algorithm.maximum_activations.values()))
+
+def main(model_name, save_to, splits, output, topn, workers, shards,
+        batch_size, memmap, levels_file):
+    create_model, Corpus, normalize = MODELS[model_name]
+    Corpus = corpus(Corpus, memmap)
+    convnet = create_model()
+
+    x = tensor.tensor4('features')
+    probs = convnet.apply(x)
+    cg = ComputationGraph([probs])
+
+    def full_brick_name(brick):
+        return '/'.join([''] + [b.name for b in brick.get_unique_path()])
+
+    outs = VariableFilter(
+            roles=[OUTPUT], bricks=[Convolutional, Linear])(cg.variables)
+
+    model = Model([probs] + outs)
+    params = load_parameters(open(save_to, 'rb'))
+    model.set_parameter_values(params)
+
+    # Compile once; the smallest snapshots are kept since the index only
+    # needs values and locations.
+    algorithm = MaximumActivationSearch(outputs=outs, topn=topn,
+            snapshot_shape=(1, 1))
+    algorithm.initialize()
+
+    # Normalizing by fixed levels rather than by batch keeps every
+    # activation independent of how the examples are split into shards
+    levels = None
+    if normalize:
+        train = Corpus(("train",))
+        train_stream = DataStream.default_stream(train,
+                iteration_scheme=SequentialScheme(train.num_examples, 1000))
+        if levels_file:
+            levels = cached_level_statistics(levels_file, train_stream)
+        else:
+            levels = level_statistics(train_stream)
+
+    _shared.update(
+        algorithm=algorithm,
+        names=[full_brick_name(get_brick(o)) for o in outs],
+        corpus=Corpus,
+        levels=levels,
+        batch_size=batch_size)
+
+    work = []
+    offset = 0
+    for split in splits:
+        num_examples = Corpus((split,)).num_examples
+        work.extend((split, start, stop, offset)
+                for start, stop in shard_ranges(num_examples, shards))
+        logging.info("Split {} is examples {} to {}".format(
+            split, offset, offset + num_examples))
+        offset += num_examples
+
+    start_time = time.time()
+    merged = None
+    with get_context('fork').Pool(workers) as pool:
+        for indexes in pool.imap_unordered(_search_shard, work):
+            if merged is None:
+                merged = indexes
+            else:
+                for name, index in indexes.items():
+                    merged[name].merge(index)
+    logging.info("Searched {} examples in {} shards in {:.1f}s".format(
+        offset, len(work), time.time() - start_time))
+
+    save_indexes(output, merged)
+    print('wrote', output)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = ArgumentParser("Sharded maximum activation search.")
+    parser.add_argument("model_name", choices=list(MODELS),
+                        help="Architecture of the saved model.")
+    parser.add_argument("save_to", default="mnist.tar", nargs="?",
+                        help="Destination to save the state of the training "
+                             "process.")
+    parser.add_argument("--splits", nargs="+", default=["test"],
+                        help="Dataset splits to search, e.g., train test.")
+    parser.add_argument("--output", default="maxact.npz",
+                        help="Where to save the merged top-k indexes.")
+    parser.add_argument("--topn", type=int, default=100,
+                        help="Number of top examples kept for each unit.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes, default one per cpu.")
+    parser.add_argument("--shards", type=int, default=16,
+                        help="Contiguous shards per split.")
+    parser.add_argument("--batch-size", type=int, default=500,
+                        help="Examples per batch within a shard.")
+    parser.add_argument("--memmap", default=None,
+                        help="Directory of arrays written by memdata.py to "
+                             "read instead of the Fuel dataset.")
+    parser.add_argument("--levels", dest="levels_file", default=None,
+                        help="File caching the channel statistics of the "
+                             "training set that inputs are normalized by; "
+                             "computed for each run when not given.")
+    args = parser.parse_args()
+    main(**vars(args))
@@ -34,8 +34,8 @@ from fuel.streams import DataStream
 from intent.lenet import LeNet
 from intent.maxact import MaximumActivationSearch
 from intent.filmstrip import Filmstrip
-from intent.rf import make_mask
-from intent.rf import layerarray_fieldmap
+from intent.rf import make_masks
+from intent.rf import output_fieldmap
 from prior import create_fair_basis
 from theano import gradient
 from theano import tensor
@@ -140,13 +140,13 @@ def main(save_to):
             background='purple')
 
         if layer in layers:
-            fieldmap = layerarray_fieldmap(layers[0:layers.index(layer) + 1])
+            fieldmap = output_fieldmap(convnet, output)
+            masks = make_masks(basis.shape[-2:], fieldmap,
+                    numpy.clip(snapshots, 0, numpy.inf))
             for unit in range(snapshots.shape[1]):
                 for index in range(snapshots.shape[0]):
-                    mask = make_mask(basis.shape[-2:], fieldmap, numpy.clip(
-                        snapshots[index, unit, :, :], 0, numpy.inf))
                     filmstrip.set_image((unit, index),
-                        basis[index, :, :, :], mask)
+                        basis[index, :, :, :], masks[index, unit])
             filmstrip.save(layer.name + '_show.jpg')
 
 if __name__ == "__main__":
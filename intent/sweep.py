@@ -0,0 +1,218 @@
+"""Single-unit ablation sweep.
+
+Measures the effect of removing each unit of one layer, with and without
+least-squares compensation by the other units, for any of the models:
+
+```
+python sweep.py lenet mnist.tar --layer /lenet/mlp/linear_0
+python sweep.py resnet resnet.tar --layer \\
+        /resnet/convolutionalsequence/group_64_17
+```
+
+Activations of the layer over the test set are cached next to the model,
+and workers forked from this process share the mmapped cache.  The result
+is written as a tab-separated per-unit table of error rate deltas and the
+most changed confusion cell, and as an .npz with the full confusion deltas.
+"""
+import logging
+from argparse import ArgumentParser
+from collections import OrderedDict
+from multiprocessing import get_context
+
+from theano import tensor
+
+from blocks.bricks.conv import Convolutional
+from blocks.bricks import Linear
+from blocks.filter import VariableFilter
+from blocks.filter import get_brick
+from blocks.graph import ComputationGraph
+from blocks.model import Model
+from blocks.roles import OUTPUT
+from blocks.serialization import load_parameters
+from fuel.datasets import CIFAR10
+from fuel.datasets import MNIST
+from fuel.schemes import SequentialScheme
+from fuel.streams import DataStream
+from intent.ablation import AblationSolver
+from intent.ablation import ablation_mixing
+from intent.ablation import create_downstream_function
+from intent.ablation import create_mixing_downstream_function
+from intent.ablation import stacked_confusion
+from intent.actcache import cache_activations
+from intent.actcache import cache_prefix
+from intent.actcache import predict_downstream
+from intent.actcache import sample_rows
+from intent.allconv import create_all_conv_net
+from intent.lenet import create_lenet_5
+from intent.memdata import corpus
+from intent.resnet import ResidualConvolutional
+from intent.resnet import create_res_net
+from intent.transform import cached_level_statistics
+from intent.transform import normalized_levels
+import numpy
+
+MODELS = OrderedDict([
+    ('lenet', (create_lenet_5, MNIST, False)),
+    ('allconv', (create_all_conv_net, CIFAR10, True)),
+    ('resnet', (create_res_net, CIFAR10, True)),
+])
+
+# Read-only state shared with forked workers, filled in before the fork.
+_shared = {}
+
+def _sweep_units(units):
+    """Confusion matrices for ablating each unit alone, (2, K, L, L),
+    without and then with compensation."""
+    num_units = _shared['num_units']
+    results = []
+    for solver in [None, _shared['solver']]:
+        mixings = numpy.stack([ablation_mixing([unit], num_units, solver,
+            dtype=_shared['dtype']) for unit in units])
+        predicted = predict_downstream(_shared['downstream'],
+                _shared['activations'], mixings,
+                batch_size=_shared['batch_size'])
+        results.append(stacked_confusion(
+                _shared['targets'], predicted, _shared['num_labels']))
+    return numpy.stack(results)
+
+def unit_sample(activations, samples=20000, images=500):
+    """A (samples, units) least-squares sample of cached activations.
+
+    For convolutional activations, every spatial position of an image is
+    a sample of the channels, so positions are drawn from a subset of
+    the images after moving the channel axis last.
+    """
+    if activations.ndim == 2:
+        return sample_rows(activations, samples)
+    subset = sample_rows(activations, images)
+    positions = numpy.moveaxis(subset, 1, -1).reshape(
+            (-1, activations.shape[1]))
+    return sample_rows(positions, samples)
+
+def write_table(filename, error_rates, confusions, base_confusion):
+    """Writes one line per unit with error rate deltas, plain and
+    compensated, and the confusion cell each changes the most."""
+    with open(filename, 'w') as table:
+        table.write('unit\terror_delta\tcompensated_error_delta\t'
+                'cell\tcell_delta\tcompensated_cell_delta\n')
+        num_labels = base_confusion.shape[0]
+        for unit in range(error_rates.shape[1]):
+            delta = confusions[:, unit] - base_confusion
+            off_diagonal = numpy.abs(delta[0]) * (1 - numpy.eye(num_labels))
+            row, col = numpy.unravel_index(
+                    off_diagonal.argmax(), off_diagonal.shape)
+            table.write('{}\t{:.4f}\t{:.4f}\t{},{}\t{}\t{}\n'.format(
+                unit, error_rates[0, unit], error_rates[1, unit],
+                row, col, delta[0, row, col], delta[1, row, col]))
+
+def main(model_name, save_to, layer, output, workers, chunk_size, samples,
+        memmap, levels_file):
+    batch_size = 500
+    output_size = 10
+    create_model, Corpus, normalize = MODELS[model_name]
+    Corpus = corpus(Corpus, memmap)
+    convnet = create_model()
+
+    x = tensor.tensor4('features')
+    probs = convnet.apply(x)
+    cg = ComputationGraph([probs])
+
+    def full_brick_name(brick):
+        return '/'.join([''] + [b.name for b in brick.get_unique_path()])
+
+    # Find layer outputs to probe
+    outs = OrderedDict((full_brick_name(get_brick(out)), out)
+            for out in VariableFilter(
+                roles=[OUTPUT],
+                bricks=[Convolutional, Linear, ResidualConvolutional])(
+                    cg.variables))
+    if layer not in outs:
+        raise ValueError("unknown layer {}; expected one of:\n{}".format(
+            layer, '\n'.join(outs.keys())))
+
+    model = Model([probs])
+    params = load_parameters(open(save_to, 'rb'))
+    model.set_parameter_values(params)
+
+    prefix = cache_prefix(save_to, layer)
+    test = Corpus(("test",))
+    test_stream = DataStream.default_stream(
+        test,
+        iteration_scheme=SequentialScheme(test.num_examples, batch_size))
+    if normalize:
+        # Normalize as the model was trained, by batch or by fixed levels
+        levels = None
+        if levels_file:
+            train = Corpus(("train",))
+            levels = cached_level_statistics(levels_file,
+                DataStream.default_stream(train,
+                    iteration_scheme=SequentialScheme(
+                        train.num_examples, 1000)))
+            prefix += '.levels'
+        test_stream = normalized_levels(test_stream, levels=levels)
+    cache = cache_activations(prefix,
+            outs[layer], test_stream, newer_than=save_to)
+    targets = cache['targets'].flatten()
+    num_units = cache['activations'].shape[1]
+
+    base_predicted = predict_downstream(
+            create_downstream_function(probs, outs[layer]),
+            cache['activations'], batch_size=batch_size)
+    base_confusion = stacked_confusion(
+            targets, base_predicted[None, :], output_size)[0]
+    logging.info("Base error rate {:.4f}".format(
+        1 - numpy.trace(base_confusion) / len(targets)))
+
+    _shared.update(
+        num_units=num_units,
+        solver=AblationSolver(unit_sample(cache['activations'], samples)),
+        dtype=cache['activations'].dtype,
+        downstream=create_mixing_downstream_function(probs, outs[layer]),
+        activations=cache['activations'],
+        targets=targets,
+        num_labels=output_size,
+        batch_size=batch_size)
+
+    chunks = [list(range(start, min(start + chunk_size, num_units)))
+            for start in range(0, num_units, chunk_size)]
+    with get_context('fork').Pool(workers) as pool:
+        confusions = numpy.concatenate(
+                list(pool.imap(_sweep_units, chunks)), axis=1)
+    error_rates = (
+            numpy.trace(base_confusion - confusions, axis1=2, axis2=3) /
+            len(targets))
+
+    output = output or '{}.sweep'.format(prefix)
+    write_table(output + '.tsv', error_rates, confusions, base_confusion)
+    numpy.savez(output + '.npz', error_rate=error_rates,
+            confusion=confusions - base_confusion,
+            base_confusion=base_confusion)
+    print('wrote', output + '.tsv', 'and', output + '.npz')
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = ArgumentParser("Single-unit ablation sweep over one layer.")
+    parser.add_argument("model_name", choices=list(MODELS),
+                        help="Architecture of the saved model.")
+    parser.add_argument("save_to", default="mnist.tar", nargs="?",
+                        help="Destination to save the state of the training "
+                             "process.")
+    parser.add_argument("--layer", default="/lenet/mlp/linear_0",
+                        help="Full brick name of the layer to sweep.")
+    parser.add_argument("--output", default=None,
+                        help="Output prefix for the .tsv and .npz tables.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes, default one per cpu.")
+    parser.add_argument("--chunk-size", type=int, default=8,
+                        help="Units evaluated together in one pass.")
+    parser.add_argument("--samples", type=int, default=20000,
+                        help="Activation samples for the least squares fit.")
+    parser.add_argument("--memmap", default=None,
+                        help="Directory of arrays written by memdata.py to "
+                             "read instead of the Fuel dataset.")
+    parser.add_argument("--levels", dest="levels_file", default=None,
+                        help="File caching the channel statistics of the "
+                             "training set, for models trained with "
+                             "--levels.")
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,178 @@
+"""Host-side index of the top-k activating examples of each unit.
+
+Unlike MaximumActivationSearch, which keeps its state in shared variables
+and merges in the graph, a TopKIndex reduces each batch to per-unit
+candidates on the host, so k is not fixed at compile time, indexes over
+different shards of a dataset can be merged exactly, and the result can
+be saved once and shared by view.py, bucket.py and the query server.
+"""
+from collections import OrderedDict
+
+from intent.actcache import ActivationSampler
+import numpy
+import os.path
+
+def _top_rows(values, k):
+    """Row indices of the k largest entries in each column, unordered."""
+    if len(values) <= k:
+        return numpy.broadcast_to(
+                numpy.arange(len(values))[:, None], values.shape)
+    return numpy.argpartition(-values, k - 1, axis=0)[:k]
+
+def _take_rows(data, rows):
+    """Picks data[rows[i, u], u] for each unit u, keeping trailing axes."""
+    units = numpy.arange(data.shape[1])[None, :]
+    return data[rows, units]
+
+class TopKIndex:
+    """Top k values of each unit, with the ids and (row, col) locations
+    of the examples that produced them.
+
+    values, ids and locations are kept as (k, units) arrays, unordered
+    within each unit; sorted() orders them by decreasing value.  Unfilled
+    slots have value -inf and id -1.
+    """
+    def __init__(self, num_units, k=100):
+        self.k = k
+        self.values = numpy.full((k, num_units), -numpy.inf)
+        self.ids = numpy.full((k, num_units), -1, dtype=numpy.int64)
+        self.locations = numpy.zeros((k, num_units, 2), dtype=numpy.int64)
+
+    @property
+    def num_units(self):
+        return self.values.shape[1]
+
+    def add_batch(self, activations, start):
+        """Merges a batch of examples numbered from start.
+
+        activations is (cases, units), or (cases, units, height, width)
+        for convolutional maps, in which case each example is scored by
+        the maximum of each unit's map, located at its argmax.
+        """
+        activations = numpy.asarray(activations)
+        cases, units = activations.shape[:2]
+        if activations.ndim > 2:
+            flat = activations.reshape((cases, units, -1))
+            argmax = flat.argmax(axis=2)
+            values = numpy.take_along_axis(
+                    flat, argmax[:, :, None], axis=2)[:, :, 0]
+            locations = numpy.stack(numpy.unravel_index(
+                argmax, activations.shape[2:]), axis=2)
+        else:
+            values = activations
+            locations = numpy.zeros((cases, units, 2), dtype=numpy.int64)
+        # Skip the batch unless something beats a unit's current k-th value
+        if not (values > self.values.min(axis=0)[None, :]).any():
+            return
+        rows = _top_rows(values, self.k)
+        self._merge(_take_rows(values, rows), rows + start,
+                _take_rows(locations, rows))
+
+    def merge(self, other):
+        """Merges another index over different examples of the same units."""
+        self._merge(other.values, other.ids, other.locations)
+
+    def _merge(self, values, ids, locations):
+        values = numpy.concatenate((self.values, values))
+        ids = numpy.concatenate((self.ids, ids))
+        locations = numpy.concatenate((self.locations, locations))
+        rows = _top_rows(values, self.k)
+        self.values = _take_rows(values, rows)
+        self.ids = _take_rows(ids, rows)
+        self.locations = _take_rows(locations, rows)
+
+    def sorted(self):
+        """Returns (values, ids, locations) ordered by decreasing value."""
+        order = numpy.argsort(-self.values, axis=0, kind='mergesort')
+        return (_take_rows(self.values, order), _take_rows(self.ids, order),
+                _take_rows(self.locations, order))
+
+    def top(self, unit, k=None):
+        """Returns the values, ids and locations for one unit, best first."""
+        order = numpy.argsort(-self.values[:, unit], kind='mergesort')[:k]
+        return (self.values[order, unit], self.ids[order, unit],
+                self.locations[order, unit])
+
+    def save(self, filename, prefix=''):
+        numpy.savez(filename, **self._arrays(prefix))
+
+    def _arrays(self, prefix=''):
+        return OrderedDict([(prefix + 'values', self.values),
+                (prefix + 'ids', self.ids),
+                (prefix + 'locations', self.locations)])
+
+    @classmethod
+    def from_arrays(cls, values, ids, locations):
+        index = cls(values.shape[1], values.shape[0])
+        index.values, index.ids, index.locations = values, ids, locations
+        return index
+
+    @classmethod
+    def load(cls, filename, prefix=''):
+        with numpy.load(filename) as data:
+            return cls.from_arrays(*(data[prefix + name]
+                for name in ['values', 'ids', 'locations']))
+
+def index_from_search(record):
+    """Converts a MaximumActivationSearch record to a TopKIndex."""
+    dims, quantity, index, snapshot = record
+    values = quantity.get_value()
+    indices = index.get_value()
+    if indices.ndim == 3:
+        ids, locations = indices[:, :, 0], indices[:, :, 1:]
+    else:
+        ids, locations = indices, numpy.zeros(indices.shape + (2,),
+                dtype=numpy.int64)
+    return TopKIndex.from_arrays(values.astype(numpy.float64),
+            ids.astype(numpy.int64), locations.astype(numpy.int64))
+
+def save_indexes(filename, indexes):
+    """Saves an OrderedDict of layer name to TopKIndex in one .npz."""
+    arrays = OrderedDict()
+    for name, index in indexes.items():
+        arrays.update(index._arrays(name + ':'))
+    numpy.savez(filename, **arrays)
+
+def load_indexes(filename):
+    """Loads the OrderedDict saved by save_indexes."""
+    with numpy.load(filename) as data:
+        names = [key[:-len(':values')] for key in data.files
+                if key.endswith(':values')]
+        return OrderedDict((name, TopKIndex.from_arrays(
+            *(data[name + ':' + part]
+                for part in ['values', 'ids', 'locations'])))
+            for name in names)
+
+def index_activations(activations, k=100, batch_size=500):
+    """Builds a TopKIndex from an array, e.g., a cached activation table."""
+    index = TopKIndex(activations.shape[1], k)
+    for start in range(0, len(activations), batch_size):
+        index.add_batch(activations[start:start + batch_size], start)
+    return index
+
+def cached_index(filename, activations, k=100, newer_than=None):
+    """Loads the index saved in filename, or builds it from activations
+    and saves it there if it is missing or older than newer_than."""
+    if os.path.exists(filename) and (newer_than is None or
+            os.path.getmtime(filename) >= os.path.getmtime(newer_than)):
+        return TopKIndex.load(filename)
+    index = index_activations(activations, k)
+    index.save(filename)
+    return index
+
+def index_stream(outputs, data_stream, k=100, start=0):
+    """Builds a TopKIndex for each layer output in one pass over a stream.
+
+    outputs - an OrderedDict from layer names to output variables.
+    start - the example number of the first example in the stream.
+    """
+    sampler = ActivationSampler(outputs)
+    indexes = None
+    for values in sampler.batches(data_stream):
+        if indexes is None:
+            indexes = OrderedDict((name, TopKIndex(v.shape[1], k))
+                    for name, v in values.items())
+        for name, v in values.items():
+            indexes[name].add_batch(v, start)
+        start += len(v)
+    return indexes
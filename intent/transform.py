@@ -1,5 +1,7 @@
 import numpy
+import os.path
 from fuel import config
+from numpy.lib.stride_tricks import as_strided
 
 from fuel.transformers.image import ExpectsAxisLabels, SourcewiseTransformer
 try:
@@ -9,14 +11,66 @@ except ImportError:
     window_batch_bchw_available = False
 
 
-class RandomFlip(SourcewiseTransformer, ExpectsAxisLabels):
+def window_batch_strided(batch, offsets_h, offsets_w, out):
+    """NumPy version of fuel's compiled window_batch_bchw.
+
+    Copies the window at (offsets_h[i], offsets_w[i]) of each image of a
+    (batch, channel, height, width) array into out, in a single gather
+    from a strided view of every window position of every image.
+    """
+    windowed_height, windowed_width = out.shape[2:]
+    batch_size, channels, height, width = batch.shape
+    windows = as_strided(batch,
+            shape=(batch_size, channels, height - windowed_height + 1,
+                width - windowed_width + 1, windowed_height, windowed_width),
+            strides=batch.strides + batch.strides[2:],
+            writeable=False)
+    # Advanced indices around the channel slice put the batch axis first
+    out[...] = windows[numpy.arange(batch_size), :, offsets_h, offsets_w]
+
+def crop_flip_views(batch, offsets_h, offsets_w, flips, out):
+    """Copies each window of batch into out, mirrored left-right where
+    flips is set, through per-image views so nothing is allocated."""
+    windowed_height, windowed_width = out.shape[2:]
+    for i, (off_h, off_w, flip) in enumerate(
+            zip(offsets_h, offsets_w, flips)):
+        window = batch[i, :, off_h:off_h + windowed_height,
+                off_w:off_w + windowed_width]
+        out[i] = window[:, :, ::-1] if flip else window
+
+class ReusedBuffers(object):
+    """Mixin for transformers that write batches into buffers kept from
+    one batch to the next.  A batch returned in a buffer is overwritten
+    by the next batch, so it must be used before the next is requested,
+    as the main loop and PrefetchingStream do."""
+    def buffer(self, name, shape, dtype):
+        """Returns the leading shape[0] entries of the named buffer,
+        reallocated, zeroed, for a longer batch or a new shape or dtype."""
+        buffers = self.__dict__.setdefault('buffers', {})
+        buffer = buffers.get(name)
+        if (buffer is None or buffer.shape[1:] != tuple(shape[1:]) or
+                len(buffer) < shape[0] or buffer.dtype != dtype):
+            buffer = buffers[name] = numpy.zeros(shape, dtype=dtype)
+        return buffer[:shape[0]]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('buffers', None)
+        return state
+
+
+class RandomFlip(ReusedBuffers, SourcewiseTransformer, ExpectsAxisLabels):
     """Randomly flip images left-right
     Parameters
     ----------
     data_stream : :class:`AbstractDataStream`
         The data stream to wrap.
+    reuse_buffers : bool
+        Write flipped batches into a buffer kept between batches instead
+        of flipping the source in place.
     """
-    def __init__(self, data_stream, **kwargs):
+    def __init__(self, data_stream, reuse_buffers=False, **kwargs):
+        self.reuse_buffers = reuse_buffers
         self.rng = kwargs.pop('rng', None)
         self.warned_axis_labels = False
         if self.rng is None:
@@ -31,7 +85,13 @@ class RandomFlip(SourcewiseTransformer, ExpectsAxisLabels):
                                 source_name)
         if isinstance(source, numpy.ndarray) and source.ndim == 4:
             batch_size = source.shape[0]
-            whichflip = self.rng.binomial(1, 0.5, batch_size)
+            whichflip = self.rng.binomial(1, 0.5, batch_size).astype(bool)
+            if self.reuse_buffers:
+                out = self.buffer(source_name, source.shape, source.dtype)
+                numpy.copyto(out, source)
+                numpy.copyto(out, source[:,:,:,::-1],
+                        where=whichflip[:, None, None, None])
+                return out
             # TODO: determine if we are allowed to flip in-place
             source[whichflip,:,:,:] = source[whichflip,:,:,::-1]
             return source
@@ -56,9 +116,15 @@ class RandomFlip(SourcewiseTransformer, ExpectsAxisLabels):
         else:
             return example
 
-class NormalizeBatchLevels(SourcewiseTransformer, ExpectsAxisLabels):
+class NormalizeBatchLevels(ReusedBuffers, SourcewiseTransformer,
+        ExpectsAxisLabels):
+    """Normalizes each channel of a batch to zero mean and unit variance.
 
-    def __init__(self, data_stream, **kwargs):
+    With reuse_buffers, the result is computed in place in a buffer kept
+    between batches, so no batch-sized arrays are allocated.
+    """
+    def __init__(self, data_stream, reuse_buffers=False, **kwargs):
+        self.reuse_buffers = reuse_buffers
         self.warned_axis_labels = False
         kwargs.setdefault('produces_examples', False)
         kwargs.setdefault('axis_labels', data_stream.axis_labels)
@@ -70,6 +136,15 @@ class NormalizeBatchLevels(SourcewiseTransformer, ExpectsAxisLabels):
                                 source_name)
         if isinstance(source, numpy.ndarray) and source.ndim == 4:
             mean_levels = source.mean(axis=(0, 2, 3), keepdims=True)
+            if self.reuse_buffers:
+                out = self.buffer(source_name, source.shape,
+                        mean_levels.dtype)
+                squares = self.buffer(source_name + ' squares',
+                        source.shape, mean_levels.dtype)
+                numpy.subtract(source, mean_levels, out=out)
+                numpy.square(out, out=squares)
+                std = numpy.sqrt(squares.mean(axis=(0, 2, 3), keepdims=True))
+                return numpy.divide(out, std, out=out)
             zeroed = source - mean_levels
             std = zeroed.std(axis=(0, 2, 3), keepdims=True)
             return zeroed / std
@@ -77,7 +152,72 @@ class NormalizeBatchLevels(SourcewiseTransformer, ExpectsAxisLabels):
             raise ValueError("uninterpretable batch format; expected an "
                              "array with ndim = 4")
 
-class RandomPadCropFlip(SourcewiseTransformer, ExpectsAxisLabels):
+class NormalizeLevels(ReusedBuffers, SourcewiseTransformer,
+        ExpectsAxisLabels):
+    """Normalizes each channel by fixed levels, e.g., the statistics of
+    the training set from cached_level_statistics, so that a batch is
+    normalized the same way whatever else is in it.
+    """
+    def __init__(self, data_stream, mean, std, reuse_buffers=False,
+            **kwargs):
+        self.mean = numpy.asarray(mean)[None, :, None, None]
+        self.scale = 1 / numpy.asarray(std)[None, :, None, None]
+        self.reuse_buffers = reuse_buffers
+        self.warned_axis_labels = False
+        kwargs.setdefault('produces_examples', False)
+        kwargs.setdefault('axis_labels', data_stream.axis_labels)
+        super(NormalizeLevels, self).__init__(data_stream, **kwargs)
+
+    def transform_source_batch(self, source, source_name):
+        self.verify_axis_labels(('batch', 'channel', 'height', 'width'),
+                                self.data_stream.axis_labels[source_name],
+                                source_name)
+        if isinstance(source, numpy.ndarray) and source.ndim == 4:
+            dtype = numpy.result_type(source.dtype, numpy.float32)
+            mean = self.mean.astype(dtype)
+            scale = self.scale.astype(dtype)
+            if self.reuse_buffers:
+                out = self.buffer(source_name, source.shape, dtype)
+                numpy.subtract(source, mean, out=out)
+                return numpy.multiply(out, scale, out=out)
+            return (source - mean) * scale
+        else:
+            raise ValueError("uninterpretable batch format; expected an "
+                             "array with ndim = 4")
+
+def level_statistics(data_stream, source='features'):
+    """Per-channel mean and standard deviation of a source over one epoch.
+
+    Batches are merged into the running statistics with the parallel
+    form of Welford's algorithm, so one pass suffices and the result is
+    numerically stable however many examples there are.
+    """
+    count, mean, m2 = 0, 0, 0
+    for batch in data_stream.get_epoch_iterator(as_dict=True):
+        data = numpy.asarray(batch[source], dtype=numpy.float64)
+        batch_count = data.size // data.shape[1]
+        batch_mean = data.mean(axis=(0, 2, 3))
+        batch_m2 = numpy.square(
+                data - batch_mean[None, :, None, None]).sum(axis=(0, 2, 3))
+        total = count + batch_count
+        delta = batch_mean - mean
+        mean = mean + delta * batch_count / total
+        m2 = m2 + batch_m2 + delta ** 2 * count * batch_count / total
+        count = total
+    return mean, numpy.sqrt(m2 / count)
+
+def cached_level_statistics(filename, data_stream, source='features'):
+    """Loads the (mean, std) saved in filename, or computes them with
+    level_statistics over data_stream and saves them there."""
+    if os.path.exists(filename):
+        with numpy.load(filename) as data:
+            return data['mean'], data['std']
+    mean, std = level_statistics(data_stream, source)
+    numpy.savez(filename, mean=mean, std=std)
+    return mean, std
+
+class RandomPadCropFlip(ReusedBuffers, SourcewiseTransformer,
+        ExpectsAxisLabels):
     """Randomly crop images to a fixed window size.
     Parameters
     ----------
@@ -86,6 +226,9 @@ class RandomPadCropFlip(SourcewiseTransformer, ExpectsAxisLabels):
     window_shape : tuple
         The `(height, width)` tuple representing the size of the output
         window.
+    reuse_buffers : bool
+        Crop and flip batches into a buffer kept between batches instead
+        of allocating a new one for each batch.
     Notes
     -----
     This transformer expects to act on stream sources which provide one of
@@ -101,12 +244,11 @@ class RandomPadCropFlip(SourcewiseTransformer, ExpectsAxisLabels):
     transformer.
     """
     def __init__(self, data_stream, window_shape,
-            pad=None, x_flip=True, **kwargs):
-        if not window_batch_bchw_available:
-            raise ImportError('window_batch_bchw not compiled')
+            pad=None, x_flip=True, reuse_buffers=False, **kwargs):
         self.window_shape = window_shape
         self.pad = pad
         self.x_flip = x_flip
+        self.reuse_buffers = reuse_buffers
         self.rng = kwargs.pop('rng', None)
         self.warned_axis_labels = False
         if self.rng is None:
@@ -123,14 +265,16 @@ class RandomPadCropFlip(SourcewiseTransformer, ExpectsAxisLabels):
         if isinstance(source, numpy.ndarray) and source.ndim == 4:
             # Hardcoded assumption of (batch, channels, height, width).
             # This is what the fast Cython code supports.
-            out = numpy.empty(source.shape[:2] + self.window_shape,
-                              dtype=source.dtype)
+            if self.reuse_buffers:
+                out = self.buffer(source_name,
+                        source.shape[:2] + self.window_shape, source.dtype)
+            else:
+                out = numpy.empty(source.shape[:2] + self.window_shape,
+                                  dtype=source.dtype)
             batch_size = source.shape[0]
             # If padding is requested, pad before making random crop.
             if self.pad is not None:
-                symmetric = (self.pad, self.pad)
-                paddims = ((0, 0), (0, 0), symmetric, symmetric)
-                source = numpy.pad(source, paddims, 'constant')
+                source = self.pad_batch(source, source_name)
             image_height, image_width = source.shape[2:]
             max_h_off = image_height - windowed_height
             max_w_off = image_width - windowed_width
@@ -140,11 +284,19 @@ class RandomPadCropFlip(SourcewiseTransformer, ExpectsAxisLabels):
                                      source.shape[2:], self.window_shape))
             offsets_w = self.rng.random_integers(0, max_w_off, size=batch_size)
             offsets_h = self.rng.random_integers(0, max_h_off, size=batch_size)
-            window_batch_bchw(source, offsets_h, offsets_w, out)
             # If flipping is requested, randomly flip images horizontally
             if self.x_flip:
-                whichflip = self.rng.binomial(1, 0.5, batch_size)
-                out[whichflip,:,:,:] = out[whichflip,:,:,::-1]
+                whichflip = self.rng.binomial(1, 0.5, batch_size).astype(bool)
+            else:
+                whichflip = numpy.zeros(batch_size, dtype=bool)
+            if self.reuse_buffers:
+                crop_flip_views(source, offsets_h, offsets_w, whichflip, out)
+                return out
+            if window_batch_bchw_available:
+                window_batch_bchw(source, offsets_h, offsets_w, out)
+            else:
+                window_batch_strided(source, offsets_h, offsets_w, out)
+            out[whichflip,:,:,:] = out[whichflip,:,:,::-1]
             return out
         elif all(isinstance(b, numpy.ndarray) and b.ndim == 3 for b in source):
             return [self.transform_source_example(im, source_name)
@@ -154,6 +306,16 @@ class RandomPadCropFlip(SourcewiseTransformer, ExpectsAxisLabels):
                              "of arrays with ndim = 3, or an array with "
                              "ndim = 4")
 
+    def pad_batch(self, source, source_name):
+        """Copies source into the middle of a reused zero-bordered buffer,
+        which is only reallocated when the image shape or dtype changes."""
+        batch_size, channels, height, width = source.shape
+        pad = self.pad
+        padded = self.buffer(source_name + ' padded', (batch_size, channels,
+            height + 2 * pad, width + 2 * pad), source.dtype)
+        padded[:, :, pad:pad + height, pad:pad + width] = source
+        return padded
+
     def transform_source_example(self, example, source_name):
         self.verify_axis_labels(('channel', 'height', 'width'),
                                 self.data_stream.axis_labels[source_name],
@@ -190,3 +352,19 @@ class RandomPadCropFlip(SourcewiseTransformer, ExpectsAxisLabels):
         if self.x_flip and self.rng.binomial(1, 0.5):
             return example[:,:,::-1]
         return example
+
+def normalized_levels(data_stream, rng=None, levels=None):
+    """The CIFAR training chain without augmentation.  Levels are
+    normalized per batch, or by the (mean, std) levels when given."""
+    if levels is not None:
+        return NormalizeLevels(data_stream, *levels,
+                which_sources=('features',), reuse_buffers=True)
+    return NormalizeBatchLevels(data_stream, which_sources=('features',),
+            reuse_buffers=True)
+
+def padded_crop_flip(data_stream, rng=None, pad=4, levels=None):
+    """The CIFAR training chain: levels normalized as by normalized_levels,
+    then a random crop of the padded images and a random flip."""
+    return RandomPadCropFlip(normalized_levels(data_stream, levels=levels),
+            (32, 32), pad=pad, which_sources=('features',), rng=rng,
+            reuse_buffers=True)
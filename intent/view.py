@@ -31,15 +31,124 @@ from fuel.schemes import SequentialScheme
 from fuel.streams import DataStream
 from intent.lenet import LeNet
 from intent.maxact import MaximumActivationSearch
+from intent.maxact import uncrop_snapshot
+from intent.topk import index_stream
+from intent.topk import load_indexes
+from intent.topk import save_indexes
 from intent.filmstrip import Filmstrip
-from intent.rf import make_mask
-from intent.rf import layerarray_fieldmap
+from intent.filmstrip import compose_grid
+from intent.filmstrip import encode_image
+from intent.filmstrip import make_sprite_atlas
+from intent.filmstrip import scale_tiles
+from intent.rf import crop_fields
+from intent.rf import make_masks
+from intent.rf import output_fieldmap
+from intent.rf import snapshot_window
+from collections import OrderedDict
+import theano
 import numpy
+import os.path
 
 # For testing
 from blocks.roles import OUTPUT
 
-def main(save_to):
+def full_brick_name(brick):
+    return '/'.join([''] + [b.name for b in brick.get_unique_path()])
+
+def search_in_graph(outs, model, snapshot_shape, data_stream):
+    """Runs MaximumActivationSearch for one epoch, returning dicts of
+    the top indices and snapshots for each output."""
+    algorithm = MaximumActivationSearch(outputs=outs,
+            snapshot_shape=snapshot_shape)
+
+    extensions = [Timing(),
+                  FinishAfter(after_n_epochs=1),
+                  DataStreamMonitoring(
+                      [],
+                      data_stream,
+                      prefix="test"),
+                  Checkpoint("maxact.tar"),
+                  ProgressBar(),
+                  Printing()]
+
+    main_loop = MainLoop(
+        algorithm,
+        data_stream,
+        model=model,
+        extensions=extensions)
+
+    main_loop.run()
+
+    indices, snapshots = {}, {}
+    for output, record in algorithm.maximum_activations.items():
+        activations, indices[output], snapshots[output] = (
+                r.get_value() if r else None for r in record[1:])
+    return indices, snapshots
+
+def default_examples(dataset, ids, batch_size=500):
+    """The examples of a dataset at an array of ids, with the default
+    stream's transformers applied, e.g., pixels scaled to floats."""
+    unique, inverse = numpy.unique(ids, return_inverse=True)
+    stream = DataStream.default_stream(dataset,
+            iteration_scheme=SequentialScheme(unique.tolist(), batch_size))
+    features = numpy.concatenate(
+            [batch[0] for batch in stream.get_epoch_iterator()])
+    return features[inverse].reshape(ids.shape + features.shape[1:])
+
+def search_with_index(outs, x, filename, data_stream, dataset):
+    """Reads or builds the shared host-side top-k index, returning dicts
+    of the top indices and recomputed activation maps for each output.
+
+    The maps of all units of a layer are recomputed in one batch of
+    their top examples, read as data_stream reads them from dataset.
+    """
+    if os.path.exists(filename):
+        indexes = load_indexes(filename)
+    else:
+        indexes = index_stream(OrderedDict(
+            (full_brick_name(get_brick(o)), o) for o in outs), data_stream)
+        save_indexes(filename, indexes)
+    snapshot_fn = theano.function([x], outs)
+    indices, snapshots = {}, {}
+    for j, output in enumerate(outs):
+        _, ids, locations = indexes[full_brick_name(get_brick(output))
+                ].sorted()
+        if output.ndim == 2:
+            indices[output] = ids
+            continue
+        indices[output] = numpy.concatenate(
+                (ids[:, :, None], locations), axis=2)
+        images = default_examples(dataset, ids)
+        maps = snapshot_fn(images.reshape((-1,) + images.shape[2:]))[j]
+        maps = maps.reshape(ids.shape + maps.shape[1:])
+        # The map of each unit in the examples ranked for that unit
+        units = numpy.arange(ids.shape[1])
+        snapshots[output] = maps[:, units, units]
+    return indices, snapshots
+
+def save_gallery(filename, images, masks, fieldmap, locations, tile_size,
+        background=(0, 0, 255)):
+    """Saves the top examples of all units of a layer as one grid.
+
+    images and masks are (examples, units, ...) stacks laid out like the
+    search indices, and locations the (examples, units, 2) activation
+    maxima.  Each example is cropped to the receptive field of its
+    maximum, with parts of the field beyond the image edge left gray,
+    and scaled to a common tile size; each row of the grid is one unit.
+    """
+    count, units = locations.shape[:2]
+    flat = lambda a: a.swapaxes(0, 1).reshape((count * units,) + a.shape[2:])
+    crops = make_sprite_atlas(crop_fields(flat(images), fieldmap,
+        flat(locations)))
+    mask_crops = crop_fields(flat(masks), fieldmap, flat(locations))
+    tiles = ((crops - 128.0) * mask_crops[:, :, :, None] + 128).astype(
+            numpy.uint8)
+    grid = compose_grid(scale_tiles(tiles, (tile_size, tile_size)),
+            (units, count), background=background)
+    with open(filename, 'wb') as f:
+        f.write(encode_image(grid, format='JPEG', quality=99))
+
+def main(save_to, snapshot_size, index_file, gallery, tile_size):
     batch_size = 365
     feature_maps = [6, 16]
     mlp_hiddens = [120, 84]
@@ -97,56 +206,71 @@ def main(save_to):
     params = load_parameters(open(save_to, 'rb'))
     model.set_parameter_values(params)
 
-    algorithm = MaximumActivationSearch(outputs=outs)
-
     # Use the mnist test set, unshuffled
     mnist_test = MNIST(("test",), sources=['features'])
     mnist_test_stream = DataStream.default_stream(
         mnist_test,
         iteration_scheme=SequentialScheme(
             mnist_test.num_examples, batch_size))
+    examples = mnist_test.get_example_stream()
+    example = examples.get_data(0)[0]
 
-    extensions = [Timing(),
-                  FinishAfter(after_n_epochs=1),
-                  DataStreamMonitoring(
-                      [],
-                      mnist_test_stream,
-                      prefix="test"),
-                  Checkpoint("maxact.tar"),
-                  ProgressBar(),
-                  Printing()]
-
-    main_loop = MainLoop(
-        algorithm,
-        mnist_test_stream,
-        model=model,
-        extensions=extensions)
+    # Windows of each map to keep, by default the receptive field's reach
+    snapshot_shape = {}
+    for output in outs:
+        if output.ndim != 4 or snapshot_size == 0:
+            continue
+        if snapshot_size is None:
+            snapshot_shape[output] = snapshot_window(
+                    output_fieldmap(convnet, output),
+                    get_brick(output).get_dim('output')[1:])
+        else:
+            snapshot_shape[output] = (snapshot_size, snapshot_size)
 
-    main_loop.run()
+    if index_file:
+        indices, snapshots = search_with_index(
+                outs, x, index_file, mnist_test_stream, mnist_test)
+        snapshot_shape = {}
+    else:
+        indices, snapshots = search_in_graph(
+                outs, model, snapshot_shape, mnist_test_stream)
 
-    examples = mnist_test.get_example_stream()
-    example = examples.get_data(0)[0]
     layers = convnet.layers
-    for output, record in algorithm.maximum_activations.items():
+    for output in outs:
         layer = get_brick(output)
-        activations, indices, snapshots = (
-                r.get_value() if r else None for r in record[1:])
         filmstrip = Filmstrip(
-            example.shape[-2:], (indices.shape[1], indices.shape[0]),
+            example.shape[-2:], (indices[output].shape[1],
+                indices[output].shape[0]),
             background='blue')
         if layer in layers:
-            fieldmap = layerarray_fieldmap(layers[0:layers.index(layer) + 1])
-            for unit in range(indices.shape[1]):
+            fieldmap = output_fieldmap(convnet, output)
+            stack = snapshots[output]
+            if snapshot_shape.get(output):
+                map_shape = layer.get_dim('output')[1:]
+                stack = numpy.array([[uncrop_snapshot(stack[index, unit],
+                        indices[output][index, unit, 1:], map_shape)
+                    for unit in range(stack.shape[1])]
+                    for index in range(stack.shape[0])])
+            masks = make_masks(example.shape[-2:], fieldmap,
+                    numpy.clip(stack, 0, numpy.inf))
+            if gallery:
+                ids = indices[output][:, :, 0]
+                images = numpy.stack([examples.get_data(imagenum)[0]
+                    for imagenum in ids.flat]).reshape(
+                        ids.shape + example.shape)
+                save_gallery(layer.name + '_gallery.jpg', images, masks,
+                        fieldmap, indices[output][:, :, 1:], tile_size)
+                continue
+            for unit in range(indices[output].shape[1]):
                 for index in range(100):
-                    mask = make_mask(example.shape[-2:], fieldmap, numpy.clip(
-                        snapshots[index, unit, :, :], 0, numpy.inf))
-                    imagenum = indices[index, unit, 0]
+                    imagenum = indices[output][index, unit, 0]
                     filmstrip.set_image((unit, index),
-                            examples.get_data(imagenum)[0], mask)
+                            examples.get_data(imagenum)[0],
+                            masks[index, unit])
         else:
-            for unit in range(indices.shape[1]):
+            for unit in range(indices[output].shape[1]):
                 for index in range(100):
-                    imagenum = indices[index, unit]
+                    imagenum = indices[output][index, unit]
                     filmstrip.set_image((unit, index),
                             examples.get_data(imagenum)[0])
         filmstrip.save(layer.name + '_maxact.jpg')
@@ -158,5 +282,20 @@ if __name__ == "__main__":
     parser.add_argument("save_to", default="mnist.tar", nargs="?",
                         help="Destination to save the state of the training "
                              "process.")
+    parser.add_argument("--snapshot-size", type=int, default=None,
+                        help="Side of the activation map window kept "
+                             "around each maximum, 0 for the whole map; "
+                             "by default each layer keeps the units whose "
+                             "receptive fields overlap the maximum's.")
+    parser.add_argument("--index", dest="index_file", default=None,
+                        help="Shared top-k index file to read, or to build "
+                             "on the host and save, instead of searching "
+                             "in the graph.")
+    parser.add_argument("--gallery", action="store_true",
+                        help="Crop each example to the receptive field of "
+                             "its maximum instead of masking the whole "
+                             "image.")
+    parser.add_argument("--tile-size", type=int, default=28,
+                        help="Side of each gallery tile in pixels.")
     args = parser.parse_args()
     main(**vars(args))
@@ -0,0 +1,52 @@
+from collections import OrderedDict
+
+import numpy
+import pytest
+
+theano = pytest.importorskip('theano')
+pytest.importorskip('blocks')
+pytest.importorskip('fuel')
+
+from theano import tensor
+
+from blocks.bricks.conv import Convolutional
+from blocks.initialization import Constant
+from blocks.initialization import IsotropicGaussian
+from fuel.datasets import IndexableDataset
+from intent import shardmax
+from intent.maxact import MaximumActivationSearch
+
+def search(shards):
+    merged = None
+    for start, stop in shards:
+        indexes = shardmax._search_shard(('test', start, stop, 0))
+        if merged is None:
+            merged = indexes
+        else:
+            merged['conv'].merge(indexes['conv'])
+    return merged['conv'].sorted()
+
+def test_shards_find_the_same_top_examples():
+    rng = numpy.random.RandomState(1)
+    features = rng.uniform(size=(90, 3, 8, 8)).astype(theano.config.floatX)
+    dataset = IndexableDataset(OrderedDict([('features', features)]),
+            axis_labels={'features': ('batch', 'channel', 'height', 'width')})
+    convolution = Convolutional(filter_size=(3, 3), num_filters=4,
+            num_channels=3, image_size=(8, 8), name='conv',
+            weights_init=IsotropicGaussian(0.1), biases_init=Constant(0))
+    convolution.initialize()
+    x = tensor.tensor4('features')
+    algorithm = MaximumActivationSearch(outputs=[convolution.apply(x)],
+            topn=5, snapshot_shape=(1, 1))
+    algorithm.initialize()
+    shardmax._shared.update(
+        algorithm=algorithm,
+        names=['conv'],
+        corpus=lambda which_sets, sources: dataset,
+        levels=(features.mean(axis=(0, 2, 3)), features.std(axis=(0, 2, 3))),
+        batch_size=16)
+    whole = search([(0, 90)])
+    sharded = search(shardmax.shard_ranges(90, 4))
+    numpy.testing.assert_allclose(whole[0], sharded[0], rtol=1e-6)
+    numpy.testing.assert_array_equal(whole[1], sharded[1])
+    numpy.testing.assert_array_equal(whole[2], sharded[2])